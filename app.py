@@ -2,19 +2,49 @@ import os
 from flask import Flask, request, abort, jsonify
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
+from sqlalchemy.exc import OperationalError, TimeoutError
+from sqlalchemy.orm import Load
+from sqlalchemy.orm.exc import StaleDataError
 from auth import AuthError, requires_auth
-from models import db_init, db_reboot, Actor, Movie
-
-PAGES = 10
+from config import (AUTH_MODE, BULK_MAX_RECORDS, MAX_PAGE_SIZE,
+                    SEARCH_MAX_LENGTH, TIMING_SAMPLE_RATE)
+from db_pool import is_statement_timeout, pool_status
+from models import (db, db_init, db_reboot, Actor, Movie, Movie_Launch,
+                    Movie_Budget_Stats, Actor_Budget_Stats, Month_Budget_Stats,
+                    bulk_insert, bulk_update, bulk_delete, attach_actors,
+                    detach_actors)
+from export import EXPORT_FORMATS, export_response
+from fast_read import json_response, read_page, read_records
+from filters import ACTOR_SORTS, MOVIE_SORTS, filter_actors, filter_movies
+from local_auth import enable_offline_auth
+from metrics import init_metrics, metrics_response
+from pagination import MAX_ID, get_sort, paginate_query, paginate_ranked
+from query_budget import init_query_budgets, query_budget
+from rate_limit import RateLimitError, init_admission_control
+from request_timing import init_request_timing
+from response_cache import cached_response
+from search import SEARCH_MODES, search_query
+from validation import (ACTOR_CHANGES, MOVIE_CHANGES, validate_actor,
+                        validate_movie, validate_links, validate_update,
+                        parse_date, parse_ids)
 
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
-    db_init(app)
+    if test_config:
+        app.config.update(test_config)
+    db_init(app, test_config)
+    if app.config.get('AUTH_MODE', AUTH_MODE) == 'offline':
+        enable_offline_auth()
     # uncomment the first time for local run
     # db_reboot()
     CORS(app, resources={r"/api/*": {"origins": "*"}})
+    init_request_timing(app, app.config.get(
+        'TIMING_SAMPLE_RATE', TIMING_SAMPLE_RATE))
+    init_query_budgets(app)
+    init_metrics(app)
+    init_admission_control(app)
 
     @app.after_request
     def after_request(response):
@@ -26,40 +56,240 @@ def create_app(test_config=None):
             'GET,PATCH,POST,DELETE,OPTIONS')
         return response
 
-    def paginate_results(request, selection):
-        page = request.args.get('page', 1, type=int)
-        start = (page - 1) * PAGES
-        end = start + PAGES
-        movie_or_actor_rows = [movie_actor.format()
-                               for movie_actor in selection]
-        return movie_or_actor_rows[start:end]
+    @app.url_value_preprocessor
+    def check_path_ids(endpoint, values):
+        # the driver cannot bind ids beyond the INTEGER columns
+        for name, value in (values or {}).items():
+            if isinstance(value, int) and value > MAX_ID:
+                abort(400, {'message': '{} is out of range.'.format(name)})
+
+    def get_include(allowed):
+        include = request.args.get('include', '')
+        include = {part for part in include.split(',') if part}
+        if not include <= allowed:
+            abort(400, {'message': 'include must be one of {}.'.format(
+                ', '.join(sorted(allowed)))})
+        return include
+
+    def get_fields(model):
+        fields = request.args.get('fields', '')
+        fields = [part for part in fields.split(',') if part]
+        if not set(fields) <= set(model.FIELDS):
+            abort(400, {'message': 'fields must be among {}.'.format(
+                ', '.join(model.FIELDS))})
+        return fields
+
+    def load_fields(query, model, fields):
+        # SELECT only the requested columns of model
+        if not fields:
+            return query
+        return query.options(Load(model).load_only(*fields))
+
+    def get_one(model, key, record_id):
+        fields = get_fields(model) or model.FIELDS
+        record = read_records(model, [record_id]).get(record_id)
+        if record is None:
+            abort(404, {'message': '{} id {} not found.'.format(
+                model.__name__, record_id)})
+        return json_response({
+            'success': True,
+            key: {field: record[field] for field in fields}
+        })
+
+    def get_many(model, key):
+        # ?ids=1,5,9 in request order, unknown ids are listed as missing
+        ids = parse_ids(request.args.get('ids', None))
+        if not ids or len(ids) > MAX_PAGE_SIZE:
+            abort(400, {'message': 'ids must be 1 to {} integers.'.format(
+                MAX_PAGE_SIZE)})
+        if request.args.get('include', None):
+            abort(400, {'message': 'include is not supported with ids.'})
+        fields = get_fields(model) or model.FIELDS
+        ids = list(dict.fromkeys(ids))
+        records = read_records(model, ids)
+        return json_response({
+            'success': True,
+            key: [{field: records[record_id][field] for field in fields}
+                  for record_id in ids if record_id in records],
+            'missing': [record_id for record_id in ids
+                        if record_id not in records]
+        })
+
+    def get_export_format():
+        export_format = request.args.get('format', 'ndjson')
+        if export_format not in EXPORT_FORMATS:
+            abort(400, {'message': 'format must be ndjson or csv.'})
+        return export_format
+
+    def search(model, column, fields):
+        q = request.args.get('q', '').strip()
+        if not q or len(q) > SEARCH_MAX_LENGTH:
+            abort(400, {'message': 'q must be 1 to {} characters.'.format(
+                SEARCH_MAX_LENGTH)})
+        mode = request.args.get('mode', 'fuzzy')
+        if mode not in SEARCH_MODES:
+            abort(400, {'message': 'mode must be prefix or fuzzy.'})
+        return paginate_ranked(request, load_fields(
+            search_query(db.session, model, column, q, mode),
+            model, fields))
+
+    def get_records(key):
+        # [...] or {key: [...]} plus ?mode= of the bulk endpoints
+        body = request.get_json()
+        records = body.get(key, None) if isinstance(body, dict) else body
+        if not isinstance(records, list) or not records:
+            abort(400, {'message': 'a list of {} is required.'.format(key)})
+        if len(records) > BULK_MAX_RECORDS:
+            abort(422, {'message': 'more than {} records.'.format(
+                BULK_MAX_RECORDS)})
+        mode = request.args.get('mode', 'atomic')
+        if mode not in ('atomic', 'partial'):
+            abort(400, {'message': 'mode must be atomic or partial.'})
+        return records, mode
+
+    def bulk_create(model, key, validate):
+        records, mode = get_records(key)
+        rows, positions, errors = [], [], []
+        for index, record in enumerate(records):
+            row, error = validate(record)
+            if error:
+                errors.append({'index': index, 'message': error})
+            else:
+                rows.append(row)
+                positions.append(index)
+
+        if errors and mode == 'atomic':
+            return jsonify({
+                'success': False,
+                'error': 422,
+                'message': 'unprocessable',
+                'errors': errors
+            }), 422
+
+        created = [None] * len(records)
+        if rows:
+            for index, new_id in zip(positions, bulk_insert(model, rows)):
+                created[index] = new_id
+        return jsonify({
+            'success': True,
+            'created': created,
+            'errors': errors
+        })
+
+    def bulk_change(model, key, checks):
+        records, mode = get_records(key)
+        changes, versions, errors = {}, {}, []
+        for index, record in enumerate(records):
+            update, error = validate_update(record, checks)
+            if not error and update[0] in changes:
+                error = 'id {} is listed twice.'.format(update[0])
+            if error:
+                errors.append({'index': index, 'message': error})
+                continue
+            record_id, values, version = update
+            changes[record_id] = values
+            if version is not None:
+                versions[record_id] = version
+
+        if errors and mode == 'atomic':
+            return jsonify({
+                'success': False,
+                'error': 422,
+                'message': 'unprocessable',
+                'errors': errors
+            }), 422
+
+        updated, conflicts, missing = {}, [], []
+        if changes:
+            updated, conflicts, missing = bulk_update(
+                model, changes, versions, partial=mode == 'partial')
+        if (conflicts or missing) and mode == 'atomic':
+            return jsonify({
+                'success': False,
+                'error': 409,
+                'message': 'conflict',
+                'conflicts': conflicts,
+                'missing': missing
+            }), 409
+        return jsonify({
+            'success': True,
+            'updated': [{'id': record_id, 'version': version}
+                        for record_id, version in updated.items()],
+            'conflicts': conflicts,
+            'missing': missing,
+            'errors': errors
+        })
+
+    def bulk_remove(model):
+        ids = parse_ids(request.args.get('ids', None))
+        if not ids or len(ids) > BULK_MAX_RECORDS:
+            abort(400, {'message': 'ids must be 1 to {} integers.'.format(
+                BULK_MAX_RECORDS)})
+        deleted = bulk_delete(model, ids)
+        return jsonify({
+            'success': True,
+            'deleted': deleted,
+            'missing': [record_id for record_id in dict.fromkeys(ids)
+                        if record_id not in deleted]
+        })
 
     @app.route('/health', methods=['GET'])
+    @query_budget(0)
     def get_health():
         return jsonify({
             'success': True,
             'health': "APP is up"
         })
 
+    @app.route('/health/db', methods=['GET'])
+    @query_budget(0)
+    def get_db_health():
+        health = {
+            'success': True,
+            'pool': pool_status(db.engine)
+        }
+        if 'replica' in app.extensions:
+            health['replica'] = app.extensions['replica'].status()
+        return jsonify(health)
+
+    @app.route('/metrics', methods=['GET'])
+    @query_budget(0)
+    def get_metrics():
+        return metrics_response(db.engine)
+
     # ----------------------------------------------
     # Actors endpoint GET/POST/DELETE/PATCH
     # ----------------------------------------------
 
     @app.route('/actors', methods=['GET'])
+    @query_budget(2)
     @requires_auth('get:actors')
+    @cached_response('actors', 'movie_launch', 'movies')
     def get_actors(payload):
-        actor_query = Actor.query.order_by(Actor.id).all()
-        paginated_actor = paginate_results(request, actor_query)
-
-        if len(paginated_actor) == 0:
+        if 'ids' in request.args:
+            return get_many(Actor, 'actors')
+        include = get_include({'movies'})
+        actors, next_cursor = read_page(
+            request, Actor, filter_actors, get_sort(request, ACTOR_SORTS),
+            get_fields(Actor), include)
+
+        if len(actors) == 0:
             abort(404, {'message': 'actors not found'})
 
-        return jsonify({
+        return json_response({
             'success': True,
-            'actors': paginated_actor
+            'actors': actors,
+            'next_cursor': next_cursor
         })
 
+    @app.route('/actors/<int:actor_id>', methods=['GET'])
+    @query_budget(1)
+    @requires_auth('get:actors')
+    def get_actor(payload, actor_id):
+        return get_one(Actor, 'actor', actor_id)
+
     @app.route('/actors', methods=['POST'])
+    @query_budget(2)
     @requires_auth('create:actors')
     def post_actors(payload):
         body = request.get_json()
@@ -82,7 +312,47 @@ def create_app(test_config=None):
             'created': new_actor.id
         })
 
+    # no query budget, one INSERT per chunk on Postgres, per row elsewhere
+    @app.route('/actors/bulk', methods=['POST'])
+    @requires_auth('create:actors')
+    def post_actors_bulk(payload):
+        return bulk_create(Actor, 'actors', validate_actor)
+
+    @app.route('/actors', methods=['PATCH'])
+    @query_budget(2)
+    @requires_auth('update:actors')
+    def patch_actors_bulk(payload):
+        return bulk_change(Actor, 'actors', ACTOR_CHANGES)
+
+    @app.route('/actors', methods=['DELETE'])
+    @query_budget(12)
+    @requires_auth('delete:actors')
+    def delete_actors_bulk(payload):
+        return bulk_remove(Actor)
+
+    @app.route('/actors/search', methods=['GET'])
+    @query_budget(1)
+    @requires_auth('get:actors')
+    @cached_response('actors')
+    def search_actors(payload):
+        fields = get_fields(Actor)
+        actors, next_page = search(Actor, Actor.name, fields)
+        return jsonify({
+            'success': True,
+            'actors': [actor.format(fields=fields) for actor in actors],
+            'next_page': next_page
+        })
+
+    @app.route('/actors/export', methods=['GET'])
+    @query_budget(1)
+    @requires_auth('get:actors')
+    def export_actors(payload):
+        return export_response(db.session, Actor,
+                               ('id', 'name', 'gender', 'age'),
+                               get_export_format())
+
     @app.route('/actors/<actor_id>', methods=['DELETE'])
+    @query_budget(12)
     @requires_auth('delete:actors')
     def delete_actors(payload, actor_id):
         if not actor_id:
@@ -98,6 +368,7 @@ def create_app(test_config=None):
         })
 
     @app.route('/actors/<actor_id>', methods=['PATCH'])
+    @query_budget(3)
     @requires_auth('update:actors')
     def update_actors(payload, actor_id):
         body = request.get_json()
@@ -130,26 +401,45 @@ def create_app(test_config=None):
     # ----------------------------------------------
 
     @app.route('/movies', methods=['GET'])
+    @query_budget(2)
     @requires_auth('get:movies')
+    @cached_response('movies', 'movie_launch', 'actors')
     def get_movies(payload):
-        movie_query = Movie.query.order_by(Movie.id).all()
-        paginated_movies = paginate_results(request, movie_query)
-        if len(paginated_movies) == 0:
+        if 'ids' in request.args:
+            return get_many(Movie, 'movies')
+        include = get_include({'actors'})
+        movies, next_cursor = read_page(
+            request, Movie, filter_movies, get_sort(request, MOVIE_SORTS),
+            get_fields(Movie), include)
+        if len(movies) == 0:
             abort(404, {'message': 'Movies not found.'})
 
-        return jsonify({
+        return json_response({
             'success': True,
-            'movies': paginated_movies
+            'movies': movies,
+            'next_cursor': next_cursor
         })
 
+    @app.route('/movies/<int:movie_id>', methods=['GET'])
+    @query_budget(1)
+    @requires_auth('get:movies')
+    def get_movie(payload, movie_id):
+        return get_one(Movie, 'movie', movie_id)
+
     @app.route('/movies', methods=['POST'])
+    @query_budget(2)
     @requires_auth('create:movies')
     def post_movies(payload):
         body = request.get_json()
+        if not body:
+            abort(400, {'message': 'Body or title or release_date not found.'})
         title = body.get('title', None)
         release_date = body.get('release_date', None)
-        if not body or not title or not release_date:
+        if not title or not release_date:
             abort(400, {'message': 'Body or title or release_date not found.'})
+        release_date = parse_date(release_date)
+        if release_date is None:
+            abort(422, {'message': 'release_date is not a valid date.'})
         movie = (Movie(
             title=title,
             release_date=release_date
@@ -160,7 +450,46 @@ def create_app(test_config=None):
             'created': movie.title
         })
 
+    @app.route('/movies/bulk', methods=['POST'])
+    @requires_auth('create:movies')
+    def post_movies_bulk(payload):
+        return bulk_create(Movie, 'movies', validate_movie)
+
+    @app.route('/movies', methods=['PATCH'])
+    @query_budget(10)
+    @requires_auth('update:movies')
+    def patch_movies_bulk(payload):
+        return bulk_change(Movie, 'movies', MOVIE_CHANGES)
+
+    @app.route('/movies', methods=['DELETE'])
+    @query_budget(13)
+    @requires_auth('delete:movies')
+    def delete_movies_bulk(payload):
+        return bulk_remove(Movie)
+
+    @app.route('/movies/search', methods=['GET'])
+    @query_budget(1)
+    @requires_auth('get:movies')
+    @cached_response('movies')
+    def search_movies(payload):
+        fields = get_fields(Movie)
+        movies, next_page = search(Movie, Movie.title, fields)
+        return jsonify({
+            'success': True,
+            'movies': [movie.format(fields=fields) for movie in movies],
+            'next_page': next_page
+        })
+
+    @app.route('/movies/export', methods=['GET'])
+    @query_budget(1)
+    @requires_auth('get:movies')
+    def export_movies(payload):
+        return export_response(db.session, Movie,
+                               ('id', 'title', 'release_date'),
+                               get_export_format())
+
     @app.route('/movies/<movie_id>', methods=['DELETE'])
+    @query_budget(13)
     @requires_auth('delete:movies')
     def delete_movies(payload, movie_id):
         if not movie_id:
@@ -175,6 +504,7 @@ def create_app(test_config=None):
         })
 
     @app.route('/movies/<movie_id>', methods=['PATCH'])
+    @query_budget(10)
     @requires_auth('update:movies')
     def update_movies(payload, movie_id):
         body = request.get_json()
@@ -184,7 +514,11 @@ def create_app(test_config=None):
         if not movie_query:
             abort(404, {'message': 'Movie id {} not found.'.format(movie_id)})
         title = body.get('title', movie_query.title)
-        release_date = body.get('release_date', movie_query.release_date)
+        release_date = movie_query.release_date
+        if 'release_date' in body:
+            release_date = parse_date(body['release_date'])
+            if release_date is None:
+                abort(422, {'message': 'release_date is not a valid date.'})
         movie_query.title = title
         movie_query.release_date = release_date
         movie_query.update()
@@ -194,6 +528,170 @@ def create_app(test_config=None):
             'movie': [movie_query.format()]
         })
 
+    # ----------------------------------------------
+    #  Casting endpoint GET/POST/DELETE on movie_launch
+    # ----------------------------------------------
+
+    def exists_or_404(model, record_id):
+        if db.session.query(model.id).filter(
+                model.id == record_id).scalar() is None:
+            abort(404, {'message': '{} id {} not found.'.format(
+                model.__name__, record_id)})
+
+    @app.route('/movies/<int:movie_id>/actors', methods=['GET'])
+    @query_budget(2)
+    @requires_auth('get:movies')
+    @cached_response('movies', 'movie_launch', 'actors')
+    def get_movie_cast(payload, movie_id):
+        fields = get_fields(Actor)
+        exists_or_404(Movie, movie_id)
+        cast_query = load_fields(db.session.query(
+            Actor, Movie_Launch.c.movie_budget).join(
+            Movie_Launch, Movie_Launch.c.Actor_id == Actor.id).filter(
+            Movie_Launch.c.Movie_id == movie_id), Actor, fields)
+        cast, next_cursor = paginate_query(
+            request, cast_query, Actor.id,
+            cursor_key=lambda row: row.Actor)
+        return jsonify({
+            'success': True,
+            'movie': movie_id,
+            'actors': [dict(actor.format(fields=fields),
+                            movie_budget=movie_budget)
+                       for actor, movie_budget in cast],
+            'next_cursor': next_cursor
+        })
+
+    @app.route('/actors/<int:actor_id>/movies', methods=['GET'])
+    @query_budget(2)
+    @requires_auth('get:actors')
+    @cached_response('actors', 'movie_launch', 'movies')
+    def get_actor_movies(payload, actor_id):
+        fields = get_fields(Movie)
+        exists_or_404(Actor, actor_id)
+        movies_query = load_fields(db.session.query(
+            Movie, Movie_Launch.c.movie_budget).join(
+            Movie_Launch, Movie_Launch.c.Movie_id == Movie.id).filter(
+            Movie_Launch.c.Actor_id == actor_id), Movie, fields)
+        movies, next_cursor = paginate_query(
+            request, movies_query, Movie.id,
+            cursor_key=lambda row: row.Movie)
+        return jsonify({
+            'success': True,
+            'actor': actor_id,
+            'movies': [dict(movie.format(fields=fields),
+                            movie_budget=movie_budget)
+                       for movie, movie_budget in movies],
+            'next_cursor': next_cursor
+        })
+
+    @app.route('/movies/<int:movie_id>/actors', methods=['POST'])
+    @query_budget(14)
+    @requires_auth('update:movies')
+    def attach_movie_cast(payload, movie_id):
+        body = request.get_json()
+        records = body.get('actors', None) if isinstance(body, dict) else body
+        if not isinstance(records, list) or not records:
+            abort(400, {'message': 'a list of actors is required.'})
+        if len(records) > BULK_MAX_RECORDS:
+            abort(422, {'message': 'more than {} records.'.format(
+                BULK_MAX_RECORDS)})
+        exists_or_404(Movie, movie_id)
+
+        budgets, errors = validate_links(records)
+        if not errors:
+            known = {actor_id for actor_id, in db.session.query(
+                Actor.id).filter(Actor.id.in_(list(budgets)))}
+            errors = [{'id': actor_id, 'message': 'actor not found.'}
+                      for actor_id in budgets if actor_id not in known]
+        if errors:
+            return jsonify({
+                'success': False,
+                'error': 422,
+                'message': 'unprocessable',
+                'errors': errors
+            }), 422
+
+        attach_actors(movie_id, budgets)
+        return jsonify({
+            'success': True,
+            'movie': movie_id,
+            'attached': list(budgets)
+        })
+
+    @app.route('/movies/<int:movie_id>/actors', methods=['DELETE'])
+    @query_budget(12)
+    @requires_auth('update:movies')
+    def detach_movie_cast(payload, movie_id):
+        actor_ids = parse_ids(request.args.get('ids', None))
+        if not actor_ids or len(actor_ids) > BULK_MAX_RECORDS:
+            abort(400, {'message': 'ids must be 1 to {} integers.'.format(
+                BULK_MAX_RECORDS)})
+        exists_or_404(Movie, movie_id)
+        detached = detach_actors(movie_id, actor_ids)
+        return jsonify({
+            'success': True,
+            'movie': movie_id,
+            'detached': detached
+        })
+
+    # ----------------------------------------------
+    #  Budget statistics from the summary tables
+    # ----------------------------------------------
+
+    @app.route('/stats/budgets', methods=['GET'])
+    @query_budget(1)
+    @requires_auth('get:movies')
+    @cached_response('movies', 'movie_launch', 'actors')
+    def get_budget_stats(payload):
+        group = request.args.get('group', 'movie')
+        if group == 'month':
+            months = db.session.execute(
+                Month_Budget_Stats.select().order_by(
+                    Month_Budget_Stats.c.release_month)).fetchall()
+            return jsonify({
+                'success': True,
+                'group': group,
+                'budgets': [dict(month) for month in months]
+            })
+
+        if group == 'movie':
+            table, key = Movie_Budget_Stats, Movie_Budget_Stats.c.movie_id
+        elif group == 'actor':
+            table, key = Actor_Budget_Stats, Actor_Budget_Stats.c.actor_id
+        else:
+            abort(400, {'message': 'group must be movie, actor or month.'})
+        id_column = key.label('id')
+        budgets, next_cursor = paginate_query(
+            request, db.session.query(id_column, *[
+                column for column in table.c if column is not key]),
+            key)
+        rows = []
+        for row in budgets:
+            budget = row._asdict()
+            budget[key.name] = budget.pop('id')
+            rows.append(budget)
+        return jsonify({
+            'success': True,
+            'group': group,
+            'budgets': rows,
+            'next_cursor': next_cursor
+        })
+
+    @app.route('/stats/actors/<int:actor_id>', methods=['GET'])
+    @query_budget(2)
+    @requires_auth('get:actors')
+    @cached_response('movies', 'movie_launch', 'actors')
+    def get_actor_stats(payload, actor_id):
+        exists_or_404(Actor, actor_id)
+        stats = db.session.execute(Actor_Budget_Stats.select().where(
+            Actor_Budget_Stats.c.actor_id == actor_id)).first()
+        return jsonify({
+            'success': True,
+            'actor': actor_id,
+            'total_budget': stats.total_budget if stats else 0,
+            'movie_count': stats.movie_count if stats else 0
+        })
+
     # ----------------------------------------------
     # Error handlers for all expected errors
     # ----------------------------------------------
@@ -245,6 +743,42 @@ def create_app(test_config=None):
             "message": "internal server error"
         }), 500
 
+    @app.errorhandler(OperationalError)
+    @app.errorhandler(TimeoutError)
+    def database_unavailable(error):
+        db.session.rollback()
+        if is_statement_timeout(error):
+            message = "statement timeout"
+        elif isinstance(error, TimeoutError):
+            message = "database pool exhausted"
+        else:
+            message = "database unavailable"
+        return jsonify({
+            "success": False,
+            "error": 503,
+            "message": message
+        }), 503, {'Retry-After': '1'}
+
+    @app.errorhandler(StaleDataError)
+    def version_conflict(error):
+        # the row changed between its SELECT and the versioned UPDATE
+        db.session.rollback()
+        return jsonify({
+            "success": False,
+            "error": 409,
+            "message": "conflict"
+        }), 409
+
+    @app.errorhandler(RateLimitError)
+    def rate_limited(error):
+        response = jsonify({
+            "success": False,
+            "error": error.status_code,
+            "message": error.message
+        })
+        response.headers['Retry-After'] = str(error.retry_after)
+        return response, error.status_code
+
     @app.errorhandler(AuthError)
     def authentication_failure(AuthError):
         return jsonify({
@@ -256,7 +790,16 @@ def create_app(test_config=None):
     return app
 
 
-app = create_app()
+_app = None
+
+
+def get_app():
+    '''The process-wide app, built on first use rather than at import.'''
+    global _app
+    if _app is None:
+        _app = create_app()
+    return _app
+
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8080, debug=True)
+    get_app().run(host='0.0.0.0', port=8080, debug=True)
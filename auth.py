@@ -1,12 +1,16 @@
-import json
 import ssl
+import time
 from functools import wraps
-from urllib.request import urlopen
 
 from flask import request
 from jose import jwt
 
 from config import AUTH0_DOMAIN, ALGORITHMS, API_AUDIENCE
+from jwks import jwks_store
+from rate_limit import check_rate_limit
+from replica import route_request
+from request_timing import record_timing
+from token_cache import token_cache
 
 ssl._create_default_https_context = ssl._create_unverified_context
 
@@ -70,6 +74,7 @@ def get_token_auth_header():
     @INPUTS
         permission: string permission (i.e. 'post:drink')
         payload: decoded jwt payload
+        permissions: optional precomputed frozenset of the payload permissions
 
     it should raise an AuthError if permissions are not included in the payload
         !!NOTE check your RBAC settings in Auth0
@@ -77,14 +82,16 @@ def get_token_auth_header():
 '''
 
 
-def check_permissions(permission, payload):
-    if 'permissions' not in payload:
-        raise AuthError({
-            'code': 'invalid_claims',
-            'description': 'Permissions missing in JWT.'
-        }, 400)
+def check_permissions(permission, payload, permissions=None):
+    if permissions is None:
+        if 'permissions' not in payload:
+            raise AuthError({
+                'code': 'invalid_claims',
+                'description': 'Permissions missing in JWT.'
+            }, 400)
+        permissions = payload['permissions']
 
-    if permission not in payload['permissions']:
+    if permission not in permissions:
         raise AuthError({
             'code': 'unauthorized',
             'description': 'Permission not found.'
@@ -99,6 +106,7 @@ def check_permissions(permission, payload):
 
     it should be an Auth0 token with key id (kid)
     it should verify the token using Auth0 /.well-known/jwks.json
+        keys come from the cached jwks_store, not a fetch per request
     it should decode the payload from the token
     it should validate the claims
     return the decoded payload
@@ -107,8 +115,6 @@ def check_permissions(permission, payload):
 
 
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
     unverified_header = jwt.get_unverified_header(token)
 
     if 'kid' not in unverified_header:
@@ -117,16 +123,7 @@ def verify_decode_jwt(token):
             'description': 'Authorization malformed.'
         }, 401)
 
-    rsa_key = {}
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    rsa_key = jwks_store.get_key(unverified_header['kid'])
     if rsa_key:
         try:
             payload = jwt.decode(
@@ -169,6 +166,9 @@ def verify_decode_jwt(token):
 
     it should use the get_token_auth_header method to get the token
     it should use the verify_decode_jwt method to decode the jwt
+        unless the token is already in the verified token_cache
+    it should take a token from the rate limit bucket of the sub
+    it should route get: requests to the read replica, if there is one
     return the decorator
 '''
 
@@ -178,15 +178,23 @@ def requires_auth(permission=''):
         @wraps(f)
         def wrapper(*args, **kwargs):
             token = get_token_auth_header()
-            try:
-                payload = verify_decode_jwt(token)
-            except BaseException:
-                raise AuthError({
-                    'code': 'unauthorized',
-                    'description': 'No Permissions'
-                }, 401)
-            check_permissions(permission, payload)
-            return f(payload, *args, **kwargs)
+            started = time.perf_counter()
+            verified = token_cache.get(token)
+            if verified is None:
+                try:
+                    payload = verify_decode_jwt(token)
+                except BaseException:
+                    raise AuthError({
+                        'code': 'unauthorized',
+                        'description': 'No Permissions'
+                    }, 401)
+                verified = token_cache.set(token, payload)
+            check_permissions(permission, verified.payload,
+                              verified.permissions)
+            check_rate_limit(permission, verified.payload)
+            route_request(permission)
+            record_timing('auth', time.perf_counter() - started)
+            return f(verified.payload, *args, **kwargs)
 
         return wrapper
 
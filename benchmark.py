@@ -0,0 +1,539 @@
+import argparse
+import itertools
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+'''
+Load-testing harness
+Seeds a dataset, mints offline tokens for each role and drives every
+route of create_app at a fixed concurrency, reporting requests/sec and
+p50/p95/p99 latency per endpoint. Results are written as JSON and can be
+compared with an earlier run:
+
+    python benchmark.py --actors 5000 --movies 1000 --output before.json
+    python benchmark.py --output after.json --compare before.json
+'''
+
+ROLES = {
+    'assistant': 'casting_assistant',
+    'director': 'casting_director',
+    'producer': 'executive_producer'
+}
+
+# name, method, path(i), role, body(i); i numbers the request in its run
+Scenario = namedtuple('Scenario', 'name method path role body')
+
+OK_STATUSES = (200, 304)
+
+# ids per DELETE ?ids= request
+BATCH_DELETE = 5
+
+
+def percentile(values, pct):
+    '''Nearest-rank percentile of sorted values.'''
+    if not values:
+        return None
+    rank = max(int(math.ceil(pct / 100.0 * len(values))) - 1, 0)
+    return values[rank]
+
+
+def seed(app, actors, movies, links, spare):
+    '''
+    Rebuilds the schema with actors and movies plus `spare` extra rows of
+    each for the DELETE scenarios, every movie is cast with `links` actors.
+    Returns (actor_ids, spare_actor_ids, movie_ids, spare_movie_ids).
+    '''
+    from models import (db, db_create, Actor, Movie, Movie_Launch,
+                        bulk_insert, refresh_budget_stats)
+    from record_cache import record_cache
+    from response_cache import bump_table_version
+
+    with app.app_context():
+        db.drop_all()
+        db_create()
+        actor_ids = bulk_insert(Actor, [{
+            'name': 'Actor {}'.format(i),
+            'gender': ('Male', 'Female')[i % 2],
+            'age': 18 + i % 60
+        } for i in range(actors + spare)])
+        movie_ids = bulk_insert(Movie, [{
+            'title': 'Movie {}'.format(i),
+            'release_date': date(2000, 1, 1) + timedelta(days=i % 9000)
+        } for i in range(movies + spare)])
+
+        cast = [{
+            'Movie_id': movie_id,
+            'Actor_id': actor_ids[(position + offset) % actors],
+            'movie_budget': 1000.0 * (offset + 1)
+        } for position, movie_id in enumerate(movie_ids[:movies])
+            for offset in range(min(links, actors))]
+        chunk = 500
+        for start in range(0, len(cast), chunk):
+            db.session.execute(Movie_Launch.insert(),
+                               cast[start:start + chunk])
+        for start in range(0, movies, chunk):
+            refresh_budget_stats(movie_ids=movie_ids[start:start + chunk])
+        for start in range(0, actors, chunk):
+            refresh_budget_stats(actor_ids=actor_ids[start:start + chunk])
+        db.session.commit()
+        record_cache.clear()
+        bump_table_version('actors', 'movies', 'movie_launch')
+
+    return (actor_ids[:actors], actor_ids[actors:],
+            movie_ids[:movies], movie_ids[movies:])
+
+
+def scenarios(actor_ids, spare_actor_ids, movie_ids, spare_movie_ids):
+    '''One scenario per route, plus variants of the hot list paths.'''
+    def pick(ids):
+        return lambda i: ids[(i * 7919) % len(ids)]
+
+    actor, movie = pick(actor_ids), pick(movie_ids)
+    # every DELETE consumes its own spare row
+    spare_actor = itertools.count()
+    spare_movie = itertools.count()
+
+    def next_spare(ids, counter):
+        return ids[next(counter) % len(ids)]
+
+    return [
+        Scenario('GET /health', 'GET', lambda i: '/health', None, None),
+        Scenario('GET /health/db', 'GET', lambda i: '/health/db',
+                 None, None),
+        Scenario('GET /metrics', 'GET', lambda i: '/metrics', None, None),
+        Scenario('GET /actors', 'GET', lambda i: '/actors',
+                 'assistant', None),
+        Scenario('GET /actors?sort&filter', 'GET',
+                 lambda i: '/actors?sort=-age&age_min={}&page_size=50'
+                 .format(18 + i % 40),
+                 'assistant', None),
+        Scenario('GET /actors?include=movies', 'GET',
+                 lambda i: '/actors?include=movies&page_size=50',
+                 'assistant', None),
+        Scenario('GET /actors/<id>', 'GET',
+                 lambda i: '/actors/{}'.format(actor(i)),
+                 'assistant', None),
+        Scenario('GET /actors?ids=', 'GET',
+                 lambda i: '/actors?ids={}'.format(','.join(
+                     str(actor(i + n)) for n in range(20))),
+                 'assistant', None),
+        Scenario('GET /actors/search', 'GET',
+                 lambda i: '/actors/search?q=Actor%20{}'.format(i % 100),
+                 'assistant', None),
+        Scenario('GET /actors/export', 'GET',
+                 lambda i: '/actors/export?format=ndjson',
+                 'assistant', None),
+        Scenario('GET /actors/<id>/movies', 'GET',
+                 lambda i: '/actors/{}/movies'.format(actor(i)),
+                 'assistant', None),
+        Scenario('GET /stats/actors/<id>', 'GET',
+                 lambda i: '/stats/actors/{}'.format(actor(i)),
+                 'assistant', None),
+        Scenario('GET /movies', 'GET', lambda i: '/movies',
+                 'assistant', None),
+        Scenario('GET /movies?include=actors', 'GET',
+                 lambda i: '/movies?include=actors&page_size=50',
+                 'assistant', None),
+        Scenario('GET /movies/<id>', 'GET',
+                 lambda i: '/movies/{}'.format(movie(i)),
+                 'assistant', None),
+        Scenario('GET /movies?ids=', 'GET',
+                 lambda i: '/movies?ids={}'.format(','.join(
+                     str(movie(i + n)) for n in range(20))),
+                 'assistant', None),
+        Scenario('GET /movies/search', 'GET',
+                 lambda i: '/movies/search?q=Movie%20{}'.format(i % 100),
+                 'assistant', None),
+        Scenario('GET /movies/export', 'GET',
+                 lambda i: '/movies/export?format=ndjson',
+                 'assistant', None),
+        Scenario('GET /movies/<id>/actors', 'GET',
+                 lambda i: '/movies/{}/actors'.format(movie(i)),
+                 'assistant', None),
+        Scenario('GET /stats/budgets', 'GET',
+                 lambda i: '/stats/budgets?group={}'.format(
+                     ('movie', 'actor', 'month')[i % 3]),
+                 'assistant', None),
+        Scenario('GET /actors (token cache miss)', 'GET',
+                 lambda i: '/actors', 'fresh', None),
+        Scenario('POST /actors', 'POST', lambda i: '/actors', 'director',
+                 lambda i: {'name': 'New actor {}'.format(i),
+                            'gender': 'Female', 'age': 30}),
+        Scenario('POST /actors/bulk', 'POST', lambda i: '/actors/bulk',
+                 'director',
+                 lambda i: {'actors': [{
+                     'name': 'Bulk actor {}-{}'.format(i, n),
+                     'gender': 'Male', 'age': 40} for n in range(50)]}),
+        Scenario('PATCH /actors/<id>', 'PATCH',
+                 lambda i: '/actors/{}'.format(actor(i)), 'director',
+                 lambda i: {'age': 20 + i % 50}),
+        Scenario('DELETE /actors/<id>', 'DELETE',
+                 lambda i: '/actors/{}'.format(
+                     next_spare(spare_actor_ids, spare_actor)),
+                 'director', None),
+        Scenario('PATCH /actors', 'PATCH', lambda i: '/actors', 'director',
+                 lambda i: {'actors': [{
+                     'id': actor_id, 'changes': {'age': 20 + i % 50}}
+                     for actor_id in {actor(i + n) for n in range(20)}]}),
+        Scenario('DELETE /actors?ids=', 'DELETE',
+                 lambda i: '/actors?ids={}'.format(','.join(
+                     str(next_spare(spare_actor_ids, spare_actor))
+                     for n in range(BATCH_DELETE))),
+                 'director', None),
+        Scenario('POST /movies', 'POST', lambda i: '/movies', 'producer',
+                 lambda i: {'title': 'New movie {}'.format(i),
+                            'release_date': '2021-05-01'}),
+        Scenario('POST /movies/bulk', 'POST', lambda i: '/movies/bulk',
+                 'producer',
+                 lambda i: {'movies': [{
+                     'title': 'Bulk movie {}-{}'.format(i, n),
+                     'release_date': '2022-01-01'} for n in range(50)]}),
+        Scenario('PATCH /movies/<id>', 'PATCH',
+                 lambda i: '/movies/{}'.format(movie(i)), 'producer',
+                 lambda i: {'title': 'Renamed movie {}'.format(i)}),
+        Scenario('DELETE /movies/<id>', 'DELETE',
+                 lambda i: '/movies/{}'.format(
+                     next_spare(spare_movie_ids, spare_movie)),
+                 'producer', None),
+        Scenario('PATCH /movies', 'PATCH', lambda i: '/movies', 'producer',
+                 lambda i: {'movies': [{
+                     'id': movie_id,
+                     'changes': {'title': 'Batch movie {}'.format(i)}}
+                     for movie_id in {movie(i + n) for n in range(20)}]}),
+        Scenario('DELETE /movies?ids=', 'DELETE',
+                 lambda i: '/movies?ids={}'.format(','.join(
+                     str(next_spare(spare_movie_ids, spare_movie))
+                     for n in range(BATCH_DELETE))),
+                 'producer', None),
+        Scenario('POST /movies/<id>/actors', 'POST',
+                 lambda i: '/movies/{}/actors'.format(movie(i)), 'producer',
+                 lambda i: {'actors': [{'id': actor(i + n),
+                                        'movie_budget': 500.0}
+                                       for n in range(3)]}),
+        Scenario('DELETE /movies/<id>/actors', 'DELETE',
+                 lambda i: '/movies/{}/actors?ids={}'.format(
+                     movie(i), actor(i + 1)),
+                 'producer', None),
+    ]
+
+
+def uncovered_routes(app, scenario_list):
+    '''Rules of the app that no scenario requests, ignoring static.'''
+    adapter = app.url_map.bind('localhost')
+    covered = set()
+    for scenario in scenario_list:
+        path = scenario.path(0).split('?')[0]
+        try:
+            rule, args = adapter.match(path, method=scenario.method,
+                                       return_rule=True)
+        except Exception:
+            continue
+        covered.add((rule.rule, scenario.method))
+    missing = []
+    for rule in app.url_map.iter_rules():
+        if rule.endpoint == 'static':
+            continue
+        for method in rule.methods - {'HEAD', 'OPTIONS'}:
+            if (rule.rule, method) not in covered:
+                missing.append('{} {}'.format(method, rule.rule))
+    return sorted(missing)
+
+
+class AppClient(object):
+    '''Drives the app in process, one test client per worker thread.'''
+
+    def __init__(self, app):
+        self.app = app
+        self.local = threading.local()
+
+    def request(self, method, path, headers, body):
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = self.app.test_client()
+        response = client.open(path, method=method, headers=headers,
+                               json=body)
+        response.get_data()
+        return response.status_code
+
+
+class HTTPClient(object):
+    '''Drives a running server, e.g. gunicorn with AUTH_MODE=offline.'''
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+
+    def request(self, method, path, headers, body):
+        data = None
+        headers = dict(headers)
+        if body is not None:
+            data = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        req = Request(self.base_url + path, data=data, headers=headers,
+                      method=method)
+        try:
+            with urlopen(req) as response:
+                response.read()
+                return response.status
+        except HTTPError as error:
+            error.read()
+            return error.code
+
+
+def scenario_headers(scenario, tokens):
+    if scenario.role == 'fresh':
+        return {'Authorization': 'Bearer ' + next(tokens['fresh'])}
+    if scenario.role:
+        return {'Authorization': 'Bearer ' + tokens[scenario.role]}
+    return {}
+
+
+def run_scenario(client, scenario, tokens, requests, concurrency):
+    def one(i):
+        headers = scenario_headers(scenario, tokens)
+        body = scenario.body(i) if scenario.body else None
+        path = scenario.path(i)
+        started = time.perf_counter()
+        status = client.request(scenario.method, path, headers, body)
+        return time.perf_counter() - started, status
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(requests)))
+    wall = time.perf_counter() - started
+
+    latencies = sorted(elapsed * 1000.0 for elapsed, status in results)
+    statuses = {}
+    for elapsed, status in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        'requests': requests,
+        'errors': sum(count for status, count in statuses.items()
+                      if int(status) not in OK_STATUSES),
+        'statuses': statuses,
+        'rps': round(requests / wall, 1) if wall else None,
+        'mean_ms': round(sum(latencies) / len(latencies), 3),
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p95_ms': round(percentile(latencies, 95), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'max_ms': round(latencies[-1], 3)
+    }
+
+
+# run in a fresh interpreter: seconds to import wsgi and peak RSS in KiB
+COLD_START = '''
+import resource, time
+started = time.perf_counter()
+import wsgi
+print(time.perf_counter() - started,
+      resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+'''
+
+
+def cold_start(runs):
+    '''Median time to build the WSGI app and peak RSS over fresh processes.'''
+    samples = []
+    for run in range(runs):
+        output = subprocess.run(
+            [sys.executable, '-c', COLD_START], check=True,
+            stdout=subprocess.PIPE, cwd=os.path.dirname(
+                os.path.abspath(__file__))).stdout.split()
+        samples.append((float(output[0]) * 1000.0, int(output[1])))
+    boot = sorted(sample[0] for sample in samples)
+    return {
+        'runs': runs,
+        'boot_ms_p50': round(percentile(boot, 50), 3),
+        'boot_ms_max': round(boot[-1], 3),
+        'rss_kib_max': max(sample[1] for sample in samples)
+    }
+
+
+def mint_tokens(requests):
+    from local_auth import mint_token
+    tokens = {role: mint_token(name) for role, name in ROLES.items()}
+    # distinct subjects so every request misses the token cache
+    tokens['fresh'] = iter([
+        mint_token('casting_assistant', sub='bench|{}'.format(i))
+        for i in range(requests)])
+    return tokens
+
+
+def run_benchmark(app=None, url=None, actors=1000, movies=200, links=3,
+                  requests=200, concurrency=4, only=None, warmup=10,
+                  seed_data=True, log=print):
+    '''
+    Seeds (unless seed_data is False), runs every scenario whose name
+    contains one of `only` and returns {scenario name: result}.
+    '''
+    if seed_data:
+        # spare rows for DELETE /<id> and DELETE ?ids=
+        ids = seed(app, actors, movies, links,
+                   (requests + warmup) * (1 + BATCH_DELETE))
+    else:
+        ids = (list(range(1, actors + 1)), [],
+               list(range(1, movies + 1)), [])
+    client = HTTPClient(url) if url else AppClient(app)
+    tokens = mint_tokens(requests + warmup)
+    selected = [scenario for scenario in scenarios(*ids)
+                if not only or any(name in scenario.name for name in only)]
+    if app is not None and not only:
+        for route in uncovered_routes(app, selected):
+            log('warning: no scenario for {}'.format(route))
+
+    results = {}
+    for scenario in selected:
+        if not seed_data and scenario.method == 'DELETE':
+            log('skipping {}, needs seeded spare rows'.format(scenario.name))
+            continue
+        if warmup:
+            run_scenario(client, scenario, tokens, warmup, 1)
+        results[scenario.name] = run_scenario(
+            client, scenario, tokens, requests, concurrency)
+        log(format_row(scenario.name, results[scenario.name]))
+    return results
+
+
+def format_row(name, result):
+    return '{:<36} {:>9} {:>9} {:>9} {:>9} {:>7}'.format(
+        name, result['rps'], result['p50_ms'], result['p95_ms'],
+        result['p99_ms'], result['errors'])
+
+
+def compare(before, after, threshold):
+    '''
+    Prints the change of rps and p50/p99 per endpoint and returns the
+    endpoints whose p99 or rps got worse by more than threshold percent.
+    '''
+    def change(old, new):
+        return (new - old) * 100.0 / old if old else 0.0
+
+    regressions = []
+    print('\n{:<36} {:>10} {:>10} {:>10}'.format(
+        'endpoint', 'rps', 'p50', 'p99'))
+    for name, new in after['endpoints'].items():
+        old = before['endpoints'].get(name)
+        if not old:
+            print('{:<36} {:>10}'.format(name, 'new'))
+            continue
+        rps = change(old['rps'], new['rps'])
+        p50 = change(old['p50_ms'], new['p50_ms'])
+        p99 = change(old['p99_ms'], new['p99_ms'])
+        flag = ''
+        if rps < -threshold or p99 > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print('{:<36} {:>+9.1f}% {:>+9.1f}% {:>+9.1f}%{}'.format(
+            name, rps, p50, p99, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Load-test every route of the casting agency API.')
+    parser.add_argument('--actors', type=int, default=1000)
+    parser.add_argument('--movies', type=int, default=200)
+    parser.add_argument('--links', type=int, default=3,
+                        help='actors cast in every movie')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per endpoint')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--only', action='append',
+                        help='run scenarios whose name contains this')
+    parser.add_argument('--profile', default=None,
+                        help='DB_PROFILE, default a temporary sqlite file')
+    parser.add_argument('--database-uri', default=None)
+    parser.add_argument('--url', default=None,
+                        help='benchmark a running server instead, it must '
+                             'share the database and LOCAL_AUTH_KEY_FILE')
+    parser.add_argument('--no-seed', action='store_true',
+                        help='use the existing rows')
+    parser.add_argument('--no-response-cache', action='store_true')
+    parser.add_argument('--rate-limit', action='store_true',
+                        help='keep the per-token rate limits, a few tokens '
+                             'send every request so they would throttle')
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--compare', default=None,
+                        help='earlier result file to compare against')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='regression threshold in percent')
+    parser.add_argument('--cold-start', type=int, default=0,
+                        help='also time N fresh imports of wsgi:app')
+    args = parser.parse_args(argv)
+
+    # before the overrides below, which the fresh processes would inherit
+    cold = cold_start(args.cold_start) if args.cold_start else None
+
+    # read by config.py at import time
+    os.environ['AUTH_MODE'] = 'offline'
+    from app import create_app
+
+    test_config = {'AUTH_MODE': 'offline',
+                   'RATE_LIMIT_ENABLED': args.rate_limit}
+    if args.no_response_cache:
+        test_config['RESPONSE_CACHE_ENABLED'] = False
+    if args.profile:
+        test_config['DB_PROFILE'] = args.profile
+    if args.database_uri:
+        test_config['SQLALCHEMY_DATABASE_URI'] = args.database_uri
+    elif not args.profile:
+        test_config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///{}'.format(
+            os.path.join(tempfile.mkdtemp(), 'benchmark.db'))
+    app = create_app(test_config)
+
+    print('{:<36} {:>9} {:>9} {:>9} {:>9} {:>7}'.format(
+        'endpoint', 'rps', 'p50 ms', 'p95 ms', 'p99 ms', 'errors'))
+    results = run_benchmark(
+        app=app, url=args.url, actors=args.actors, movies=args.movies,
+        links=args.links, requests=args.requests,
+        concurrency=args.concurrency, only=args.only, warmup=args.warmup,
+        seed_data=not args.no_seed)
+
+    report = {
+        'meta': {
+            'started': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'database': app.config['SQLALCHEMY_DATABASE_URI'].split('@')[-1],
+            'url': args.url,
+            'actors': args.actors,
+            'movies': args.movies,
+            'links': args.links,
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'response_cache': not args.no_response_cache,
+            'rate_limit': args.rate_limit
+        },
+        'endpoints': results
+    }
+    if cold:
+        report['cold_start'] = cold
+        print('cold start: {boot_ms_p50} ms p50, {boot_ms_max} ms max, '
+              '{rss_kib_max} KiB peak RSS'.format(**report['cold_start']))
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2)
+    print('results written to {}'.format(args.output))
+
+    if args.compare:
+        with open(args.compare) as before:
+            regressions = compare(json.load(before), report, args.threshold)
+        if regressions:
+            print('{} endpoint(s) regressed more than {}%'.format(
+                len(regressions), args.threshold))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
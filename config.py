@@ -4,10 +4,110 @@ AUTH0_DOMAIN = 'fsnd007.us.auth0.com'
 ALGORITHMS = ['RS256']
 API_AUDIENCE = 'view_movies_actors'
 
+# JWKS key store, JWKS_FILE or a stub JWKS_URL allow offline runs
+JWKS_URL = os.environ.get(
+    'JWKS_URL', 'https://{}/.well-known/jwks.json'.format(AUTH0_DOMAIN))
+JWKS_FILE = os.environ.get('JWKS_FILE')
+JWKS_TTL = int(os.environ.get('JWKS_TTL', 3600))
+JWKS_REFRESH_AHEAD = int(os.environ.get('JWKS_REFRESH_AHEAD', 300))
+JWKS_MIN_REFETCH_INTERVAL = int(
+    os.environ.get('JWKS_MIN_REFETCH_INTERVAL', 30))
+JWKS_FETCH_TIMEOUT = int(os.environ.get('JWKS_FETCH_TIMEOUT', 5))
+
+# auth0 verifies Auth0 tokens, offline verifies tokens from local_auth
+AUTH_MODE = os.environ.get('AUTH_MODE', 'auth0')
+# PEM file shared by processes minting and verifying offline tokens
+LOCAL_AUTH_KEY_FILE = os.environ.get('LOCAL_AUTH_KEY_FILE')
+
+# verified tokens kept until their exp
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 10000))
+
 database_name = "casting_agency"
 #   uncomment for local run
 #   database_path = "postgres://{}/{}".format('localhost:5432', database_name)
 
 database_path = os.environ.get('DATABASE_URL')
 
+# backend profiles, DB_PROFILE or create_app({'DB_PROFILE': ...}) selects one
+DB_PROFILE = os.environ.get('DB_PROFILE', 'env')
+DB_PROFILES = {
+    'env': database_path,
+    'sqlite-memory': 'sqlite://',
+    'sqlite-file': 'sqlite:///{}.db'.format(database_name),
+    'postgres-local': 'postgresql://localhost:5432/{}'.format(database_name)
+}
+
+# connection pool (Postgres), timeouts in seconds unless noted
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', 10))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = os.environ.get(
+    'DB_POOL_PRE_PING', 'true').lower() == 'true'
+DB_STATEMENT_TIMEOUT_MS = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 5000))
+
+# optional streaming replica serving the get: requests
+REPLICA_DATABASE_URL = os.environ.get('REPLICA_DATABASE_URL')
+# seconds a client reads from the primary after it wrote, keep it above
+# the lag the replica is allowed
+READ_YOUR_WRITES_SECONDS = float(
+    os.environ.get('READ_YOUR_WRITES_SECONDS', 5))
+REPLICA_MAX_LAG_SECONDS = float(os.environ.get('REPLICA_MAX_LAG_SECONDS', 2))
+REPLICA_LAG_CHECK_INTERVAL = float(
+    os.environ.get('REPLICA_LAG_CHECK_INTERVAL', 1))
+
+# pagination defaults for list endpoints
+PAGE_SIZE = int(os.environ.get('PAGE_SIZE', 10))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 100))
+
+# GET response cache, entries are invalidated by table version bumps
+RESPONSE_CACHE_ENABLED = os.environ.get(
+    'RESPONSE_CACHE_ENABLED', 'true').lower() == 'true'
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 1024))
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 30))
+
+# fraction of requests timed with a Server-Timing header and a log line
+TIMING_SAMPLE_RATE = float(os.environ.get('TIMING_SAMPLE_RATE', 0.01))
+
+# query budget warnings, always on when the app runs in debug mode
+QUERY_BUDGET_WARNINGS = os.environ.get(
+    'QUERY_BUDGET_WARNINGS', 'false').lower() == 'true'
+# statements of the same shape in one request that look like an N+1
+QUERY_REPEAT_THRESHOLD = int(os.environ.get('QUERY_REPEAT_THRESHOLD', 3))
+
+# actors and movies served by the single-record and ?ids= endpoints
+RECORD_CACHE_SIZE = int(os.environ.get('RECORD_CACHE_SIZE', 10000))
+RECORD_CACHE_TTL = int(os.environ.get('RECORD_CACHE_TTL', 30))
+
+# token buckets per JWT sub and permission, "permission=rate/burst" with
+# rate in requests per second, a verb ('get') or 'default' covers the rest
+RATE_LIMIT_ENABLED = os.environ.get(
+    'RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+RATE_LIMITS = os.environ.get(
+    'RATE_LIMITS', 'get=50/100,create=10/20,update=10/20,delete=5/10')
+RATE_LIMIT_KEYS = int(os.environ.get('RATE_LIMIT_KEYS', 100000))
+# requests served at once by a process, 503 beyond it; defaults to the
+# pool size plus overflow so the pool never makes requests wait
+MAX_IN_FLIGHT = int(os.environ.get(
+    'MAX_IN_FLIGHT', DB_POOL_SIZE + DB_MAX_OVERFLOW))
+IN_FLIGHT_RETRY_AFTER = int(os.environ.get('IN_FLIGHT_RETRY_AFTER', 1))
+
+# /metrics of every gunicorn worker, each writes its snapshot to the
+# directory every METRICS_FLUSH_INTERVAL seconds; unset serves one process
+METRICS_DIR = os.environ.get('METRICS_DIR')
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 1))
+
+# longest accepted ?q= for the search endpoints
+SEARCH_MAX_LENGTH = int(os.environ.get('SEARCH_MAX_LENGTH', 100))
+
+# bulk write endpoints
+BULK_MAX_RECORDS = int(os.environ.get('BULK_MAX_RECORDS', 5000))
+BULK_CHUNK_SIZE = int(os.environ.get('BULK_CHUNK_SIZE', 1000))
+
+# manage.py import reports progress every N rows
+IMPORT_PROGRESS_EVERY = int(os.environ.get('IMPORT_PROGRESS_EVERY', 100000))
+
+# rows fetched per server-side cursor batch by the export endpoints
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 1000))
+
 # for local run find tokens from readme
@@ -0,0 +1,109 @@
+import sqlite3
+import threading
+import time
+
+from sqlalchemy import event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+from config import (DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT,
+                    DB_POOL_RECYCLE, DB_POOL_PRE_PING,
+                    DB_STATEMENT_TIMEOUT_MS)
+
+'''
+Connection pool configuration and statistics
+Postgres engines get a sized QueuePool with pre-ping and recycling, a
+server-side statement_timeout, and checkout wait times are recorded so
+pool saturation is visible before workers start timing out.
+'''
+
+# SQLSTATE for a statement cancelled by statement_timeout
+QUERY_CANCELED = '57014'
+
+
+class PoolStats:
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self._lock = threading.Lock()
+
+    def record_wait(self, seconds, timed_out=False):
+        with self._lock:
+            self.checkouts += 1
+            self.timeouts += int(timed_out)
+            self.wait_seconds_total += seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+
+
+pool_stats = PoolStats()
+
+
+class TimedQueuePool(QueuePool):
+    '''QueuePool that records how long each checkout waited.'''
+
+    def _do_get(self):
+        started = time.monotonic()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            pool_stats.record_wait(time.monotonic() - started, True)
+            raise
+        pool_stats.record_wait(time.monotonic() - started)
+        return connection
+
+
+def engine_options(database_uri):
+    '''SQLALCHEMY_ENGINE_OPTIONS for database_uri.'''
+    if not database_uri or database_uri.startswith('sqlite'):
+        return {}
+    options = {
+        'poolclass': TimedQueuePool,
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': DB_POOL_PRE_PING
+    }
+    if database_uri.startswith('postgres') and DB_STATEMENT_TIMEOUT_MS:
+        options['connect_args'] = {
+            'options': '-c statement_timeout={}'.format(
+                DB_STATEMENT_TIMEOUT_MS)
+        }
+    return options
+
+
+def pool_status(engine):
+    pool = engine.pool
+    status = {
+        'checkouts': pool_stats.checkouts,
+        'timeouts': pool_stats.timeouts,
+        'wait_seconds_total': round(pool_stats.wait_seconds_total, 6),
+        'wait_seconds_max': round(pool_stats.wait_seconds_max, 6)
+    }
+    if isinstance(pool, QueuePool):
+        capacity = pool.size() + max(pool._max_overflow, 0)
+        status.update({
+            'size': pool.size(),
+            'checked_out': pool.checkedout(),
+            'checked_in': pool.checkedin(),
+            'overflow': max(pool.overflow(), 0),
+            'saturation': round(pool.checkedout() / capacity, 3)
+            if capacity else None
+        })
+    return status
+
+
+@event.listens_for(Engine, 'connect')
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    # ON DELETE CASCADE on movie_launch needs foreign keys turned on
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+
+def is_statement_timeout(error):
+    return getattr(getattr(error, 'orig', None), 'pgcode',
+                   None) == QUERY_CANCELED
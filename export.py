@@ -0,0 +1,69 @@
+import csv
+import io
+import json
+from datetime import date
+
+from flask import Response, stream_with_context
+
+from config import EXPORT_BATCH_SIZE
+
+'''
+Streaming catalog export
+Rows are read with a server-side cursor (yield_per) and written out
+through a generator one batch at a time, so memory stays flat.
+'''
+
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv'
+}
+
+
+def json_default(value):
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError('{} is not JSON serializable'.format(type(value)))
+
+
+def ndjson_chunks(rows, columns):
+    lines = []
+    for row in rows:
+        lines.append(json.dumps(dict(zip(columns, row)),
+                                default=json_default))
+        lines.append('\n')
+        if len(lines) >= 2 * EXPORT_BATCH_SIZE:
+            yield ''.join(lines)
+            lines = []
+    if lines:
+        yield ''.join(lines)
+
+
+def csv_chunks(rows, columns):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for count, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if count % EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def export_response(session, model, columns, export_format):
+    '''
+    Streams every row of model as NDJSON or CSV in id order.
+    '''
+    query = session.query(
+        *[getattr(model, column) for column in columns]).order_by(
+        model.id).execution_options(
+        stream_results=True).yield_per(EXPORT_BATCH_SIZE)
+    chunks = ndjson_chunks if export_format == 'ndjson' else csv_chunks
+    response = Response(
+        stream_with_context(chunks(query, columns)),
+        mimetype=EXPORT_FORMATS[export_format])
+    response.headers['Content-Disposition'] = \
+        'attachment; filename={}.{}'.format(model.__tablename__,
+                                            export_format)
+    return response
@@ -0,0 +1,140 @@
+import json
+import time
+from datetime import date
+from functools import lru_cache
+
+from flask import current_app
+from sqlalchemy import select
+from werkzeug.http import http_date
+
+from models import db, Actor, Movie, Movie_Launch
+from pagination import paginate_query
+from record_cache import record_cache
+from replica import replica_may_be_stale
+from request_timing import record_timing
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - stdlib fallback
+    orjson = None
+
+'''
+Fast read path for the list endpoints
+Selects only the needed columns as plain tuples, so no ORM objects are
+built or tracked in the identity map, and maps them to __slots__ records.
+Responses are serialized with orjson when it is installed, dates keep the
+RFC 1123 format of Flask's encoder so payloads do not change.
+'''
+
+# model: (nested key, related model, parent column, related column)
+RELATED = {
+    Actor: ('movies', Movie, Movie_Launch.c.Actor_id,
+            Movie_Launch.c.Movie_id),
+    Movie: ('actors', Actor, Movie_Launch.c.Movie_id,
+            Movie_Launch.c.Actor_id)
+}
+
+_record_types = {}
+
+
+class Record:
+    '''A row as named slots, serialized as a dict of them.'''
+    __slots__ = ()
+
+    def __init__(self, values):
+        for field, value in zip(self.__slots__, values):
+            setattr(self, field, value)
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
+
+def record_type(model, fields):
+    '''Record subclass with one slot per field, built once per shape.'''
+    key = (model, fields)
+    if key not in _record_types:
+        _record_types[key] = type(model.__name__ + 'Record', (Record,),
+                                  {'__slots__': fields})
+    return _record_types[key]
+
+
+def read_page(request, model, filter_query, sort, fields=(), include=()):
+    '''
+    (records, next_cursor) of the requested page of model, filtered by
+    filter_query(request, query) and paginated like paginate_query.
+    '''
+    fields = tuple(fields or model.FIELDS)
+    extra = tuple(key for key in ('id', sort.key) if key not in fields)
+    columns = [getattr(model, key) for key in fields + extra]
+    query = filter_query(request, db.session.query(*columns))
+    rows, next_cursor = paginate_query(request, query, model.id, sort=sort)
+
+    record = record_type(model, fields + tuple(include))
+    width = len(fields)
+    records = [record(row[:width]) for row in rows]
+    if include and rows:
+        attach_related(model, records, [row.id for row in rows])
+    return records, next_cursor
+
+
+def attach_related(model, records, ids):
+    '''Fills the nested list of every record with one query.'''
+    key, related, parent, child = RELATED[model]
+    columns = [getattr(related, field) for field in related.FIELDS]
+    nested = record_type(related, related.FIELDS)
+    grouped = {record_id: [] for record_id in ids}
+    for row in db.session.execute(select([parent] + columns).select_from(
+            Movie_Launch.join(related.__table__, child == related.id)).where(
+            parent.in_(ids)).order_by(parent, related.id)):
+        grouped[row[0]].append(nested(row[1:]))
+    for record, record_id in zip(records, ids):
+        setattr(record, key, grouped[record_id])
+
+
+def read_records(model, ids):
+    '''
+    {id: column values} of the ids that exist, from the record cache and
+    one WHERE id IN (...) query for the ids it does not hold.
+    '''
+    table = model.__tablename__
+    found = record_cache.get_many(table, ids)
+    missing = [record_id for record_id in ids if record_id not in found]
+    if missing:
+        columns = [getattr(model, field) for field in model.FIELDS]
+        fetched = {row.id: dict(row) for row in db.session.execute(
+            select(columns).where(model.id.in_(missing)))}
+        if not replica_may_be_stale():
+            record_cache.set_many(table, fetched)
+        found.update(fetched)
+    return found
+
+
+@lru_cache(maxsize=4096)
+def format_date(value):
+    return http_date(value.timetuple())
+
+
+def encode_default(o):
+    if isinstance(o, Record):
+        return o.as_dict()
+    if isinstance(o, date):
+        return format_date(o)
+    raise TypeError('{} is not JSON serializable'.format(type(o).__name__))
+
+
+def dumps(payload):
+    if orjson is not None:
+        return orjson.dumps(
+            payload, default=encode_default,
+            option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_SORT_KEYS)
+    return json.dumps(payload, default=encode_default, sort_keys=True,
+                      separators=(',', ':')).encode('utf-8')
+
+
+def json_response(payload):
+    '''jsonify for payloads holding records.'''
+    started = time.perf_counter()
+    body = dumps(payload)
+    record_timing('serialize', time.perf_counter() - started)
+    return current_app.response_class(body + b'\n',
+                                      mimetype='application/json')
@@ -0,0 +1,67 @@
+from flask import abort
+
+from models import Actor, Movie
+from validation import parse_date
+
+'''
+List filters and sort whitelists
+Query parameters compile to SQL predicates backed by the indexes in
+models.py, nothing is filtered in Python.
+'''
+
+ACTOR_SORTS = {
+    'id': Actor.id,
+    'name': Actor.name,
+    'age': Actor.age
+}
+
+MOVIE_SORTS = {
+    'id': Movie.id,
+    'title': Movie.title,
+    'release_date': Movie.release_date
+}
+
+
+def int_arg(request, name):
+    value = request.args.get(name, None)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        abort(400, {'message': '{} must be an integer.'.format(name)})
+
+
+def date_arg(request, name):
+    value = request.args.get(name, None)
+    if value is None:
+        return None
+    parsed = parse_date(value)
+    if parsed is None:
+        abort(400, {'message': '{} must be a date.'.format(name)})
+    return parsed
+
+
+def filter_actors(request, query):
+    '''?age_min=, ?age_max= (inclusive) and ?gender='''
+    age_min = int_arg(request, 'age_min')
+    age_max = int_arg(request, 'age_max')
+    gender = request.args.get('gender', None)
+    if gender is not None:
+        query = query.filter(Actor.gender == gender)
+    if age_min is not None:
+        query = query.filter(Actor.age >= age_min)
+    if age_max is not None:
+        query = query.filter(Actor.age <= age_max)
+    return query
+
+
+def filter_movies(request, query):
+    '''?release_date_from= and ?release_date_to= (inclusive)'''
+    release_from = date_arg(request, 'release_date_from')
+    release_to = date_arg(request, 'release_date_to')
+    if release_from is not None:
+        query = query.filter(Movie.release_date >= release_from)
+    if release_to is not None:
+        query = query.filter(Movie.release_date <= release_to)
+    return query
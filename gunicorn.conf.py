@@ -0,0 +1,52 @@
+import glob
+import multiprocessing
+import os
+
+'''
+Gunicorn settings, used by the Procfile: gunicorn -c gunicorn.conf.py wsgi:app
+With preload_app the master imports wsgi and builds the app once, workers
+are forked from it and share those pages copy-on-write instead of each
+importing everything again. Connections must not cross the fork, so the
+master drops its pool before forking and every worker starts a new one.
+'''
+
+bind = '0.0.0.0:{}'.format(os.environ.get('PORT', '8000'))
+workers = int(os.environ.get(
+    'WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+# more than one thread switches the workers to gthread
+threads = int(os.environ.get('GUNICORN_THREADS', 1))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'true').lower() == 'true'
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 0))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 0))
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG', None)
+
+
+def on_starting(server):
+    # snapshots left by the workers of an earlier run would be added up
+    directory = os.environ.get('METRICS_DIR')
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        for path in glob.glob(os.path.join(directory, 'metrics-*.json')):
+            os.remove(path)
+
+
+def when_ready(server):
+    if not server.cfg.preload_app:
+        return
+    from config import AUTH_MODE
+    from jwks import jwks_store
+    from models import db_engines
+    # workers inherit the Auth0 keys instead of each fetching them
+    if AUTH_MODE == 'auth0':
+        jwks_store.refresh()
+    for engine in db_engines():
+        engine.dispose()
+
+
+def post_fork(server, worker):
+    if not server.cfg.preload_app:
+        return
+    from models import db_engines
+    for engine in db_engines():
+        engine.dispose()
@@ -0,0 +1,202 @@
+import csv
+import io
+import json
+import time
+
+from config import IMPORT_PROGRESS_EVERY
+
+'''
+Bulk catalog import through PostgreSQL COPY
+Records are streamed from CSV/NDJSON files into a temporary staging
+table with COPY FROM STDIN, then upserted into the real table. Only one
+read buffer of records is held in memory.
+'''
+
+# lifts the pool's statement_timeout for the rest of the transaction,
+# a COPY or upsert of millions of rows runs far longer than a request
+NO_STATEMENT_TIMEOUT = 'SET LOCAL statement_timeout = 0'
+
+IMPORT_TABLES = {
+    'actors': ('actors', ('id', 'name', 'gender', 'age')),
+    'movies': ('movies', ('id', 'title', 'release_date')),
+    'links': ('movie_launch', ('Movie_id', 'Actor_id', 'movie_budget'))
+}
+
+
+def quote(identifier):
+    return '"{}"'.format(identifier)
+
+
+def read_records(path):
+    '''Yields dicts from a .csv file or a .ndjson/.jsonl file.'''
+    with open(path, newline='') as source:
+        if path.endswith('.csv'):
+            for record in csv.DictReader(source):
+                yield record
+        else:
+            for line in source:
+                if line.strip():
+                    yield json.loads(line)
+
+
+class CopyStream:
+    '''
+    File-like object for cursor.copy_expert that renders records
+    into COPY CSV lines on demand and reports progress.
+    '''
+
+    def __init__(self, records, columns, report, label):
+        self.records = iter(records)
+        self.columns = columns
+        self.report = report
+        self.label = label
+        self.count = 0
+        self.started = time.monotonic()
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer)
+        self._pending = ''
+
+    def _next_rows(self, size):
+        for record in self.records:
+            # empty CSV fields are loaded as NULL
+            self._writer.writerow([
+                None if record.get(column) in ('', None)
+                else record.get(column) for column in self.columns])
+            self.count += 1
+            if self.count % IMPORT_PROGRESS_EVERY == 0:
+                self.report(self.progress())
+            if self._buffer.tell() >= size:
+                break
+        chunk = self._buffer.getvalue()
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        return chunk
+
+    def read(self, size=65536):
+        if size is None or size < 0:
+            size = 65536
+        while len(self._pending) < size:
+            chunk = self._next_rows(size)
+            if not chunk:
+                break
+            self._pending += chunk
+        data, self._pending = self._pending[:size], self._pending[size:]
+        return data
+
+    def progress(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        return '{}: {:,} rows in {:.1f}s ({:,.0f} rows/s)'.format(
+            self.label, self.count, elapsed, self.count / elapsed)
+
+
+def upsert_statements(table, columns, staging):
+    '''
+    Statements moving the staging table into table, in order.
+    Rows with an id are upserted, rows without one are inserted with ids
+    from the sequence once it is set past every id already taken.
+    '''
+    column_list = ', '.join(quote(column) for column in columns)
+    if table == 'movie_launch':
+        return (
+            'INSERT INTO movie_launch ({columns}) '
+            'SELECT DISTINCT ON (s."Movie_id", s."Actor_id") {selected} '
+            'FROM {staging} s '
+            'JOIN movies m ON m.id = s."Movie_id" '
+            'JOIN actors a ON a.id = s."Actor_id" '
+            'ON CONFLICT ("Movie_id", "Actor_id") '
+            'DO UPDATE SET movie_budget = EXCLUDED.movie_budget'.format(
+                columns=column_list, staging=staging,
+                selected=', '.join('s.' + quote(c) for c in columns)),)
+
+    others = [column for column in columns if column != 'id']
+    other_list = ', '.join(quote(column) for column in others)
+    return (
+        "SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+        'GREATEST((SELECT MAX(id) FROM {table}), '
+        '(SELECT MAX(id) FROM {staging}), 1))'.format(
+            table=table, staging=staging),
+        'INSERT INTO {table} ({columns}) '
+        'SELECT DISTINCT ON (id) {columns} FROM {staging} '
+        'WHERE id IS NOT NULL ORDER BY id '
+        'ON CONFLICT (id) DO UPDATE SET {updates}, '
+        'version = {table}.version + 1'.format(
+            table=table, columns=column_list, staging=staging,
+            updates=', '.join('{0} = EXCLUDED.{0}'.format(quote(column))
+                              for column in others)),
+        'INSERT INTO {table} ({others}) '
+        'SELECT {others} FROM {staging} WHERE id IS NULL'.format(
+            table=table, others=other_list, staging=staging))
+
+
+def import_file(connection, kind, path, report=print):
+    '''
+    Loads one file into actors, movies or links and commits.
+    Returns the number of rows read from the file.
+    '''
+    table, columns = IMPORT_TABLES[kind]
+    staging = 'import_' + table
+    stream = CopyStream(read_records(path), columns, report, kind)
+    cursor = connection.cursor()
+    try:
+        cursor.execute(NO_STATEMENT_TIMEOUT)
+        cursor.execute(
+            'CREATE TEMP TABLE {staging} ON COMMIT DROP AS '
+            'SELECT {columns} FROM {table} WITH NO DATA'.format(
+                staging=staging, table=table,
+                columns=', '.join(quote(column) for column in columns)))
+        cursor.copy_expert(
+            'COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(
+                staging, ', '.join(quote(column) for column in columns)),
+            stream)
+        upserted = 0
+        for statement in upsert_statements(table, columns, staging):
+            cursor.execute(statement)
+            if statement.startswith('INSERT'):
+                upserted += cursor.rowcount
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+    report(stream.progress())
+    report('{}: {:,} rows upserted into {}'.format(kind, upserted, table))
+    return stream.count
+
+
+REBUILD_BUDGET_STATS = (
+    'DELETE FROM month_budget_stats',
+    'DELETE FROM actor_budget_stats',
+    'DELETE FROM movie_budget_stats',
+    'INSERT INTO movie_budget_stats '
+    '(movie_id, release_month, total_budget, actor_count) '
+    "SELECT m.id, date_trunc('month', m.release_date)::date, "
+    'COALESCE(SUM(l.movie_budget), 0), COUNT(l."Actor_id") '
+    'FROM movies m JOIN movie_launch l ON l."Movie_id" = m.id '
+    'GROUP BY m.id, m.release_date',
+    'INSERT INTO actor_budget_stats (actor_id, total_budget, movie_count) '
+    'SELECT l."Actor_id", COALESCE(SUM(l.movie_budget), 0), '
+    'COUNT(l."Movie_id") FROM movie_launch l '
+    'JOIN movies m ON m.id = l."Movie_id" GROUP BY l."Actor_id"',
+    'INSERT INTO month_budget_stats '
+    '(release_month, total_budget, movie_count) '
+    'SELECT release_month, SUM(total_budget), COUNT(*) '
+    'FROM movie_budget_stats WHERE release_month IS NOT NULL '
+    'GROUP BY release_month'
+)
+
+
+def rebuild_budget_stats(connection, report=print):
+    '''Recomputes the budget summary tables after a bulk import.'''
+    cursor = connection.cursor()
+    try:
+        cursor.execute(NO_STATEMENT_TIMEOUT)
+        for statement in REBUILD_BUDGET_STATS:
+            cursor.execute(statement)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+    report('budget stats rebuilt')
@@ -0,0 +1,124 @@
+import json
+import threading
+import time
+from urllib.request import urlopen
+
+from config import (JWKS_URL, JWKS_FILE, JWKS_TTL, JWKS_REFRESH_AHEAD,
+                    JWKS_MIN_REFETCH_INTERVAL, JWKS_FETCH_TIMEOUT)
+from request_timing import record_timing
+
+'''
+JWKS key store
+Keeps the signing keys indexed by kid with a TTL.
+Keys are refreshed in the background before they expire, an unknown
+kid triggers at most one forced refetch per JWKS_MIN_REFETCH_INTERVAL
+and the last good key set is served while the IdP is unreachable.
+'''
+
+
+class JWKSStore:
+    def __init__(self, url=JWKS_URL, path=None, ttl=JWKS_TTL,
+                 refresh_ahead=JWKS_REFRESH_AHEAD,
+                 min_refetch_interval=JWKS_MIN_REFETCH_INTERVAL,
+                 timeout=JWKS_FETCH_TIMEOUT):
+        self.url = url
+        self.path = path
+        self.ttl = ttl
+        self.refresh_ahead = min(refresh_ahead, ttl)
+        self.min_refetch_interval = min_refetch_interval
+        self.timeout = timeout
+        self.fetch_count = 0
+        self.fetch_errors = 0
+        self.fetch_seconds = 0.0
+        self._keys = {}
+        self._static = None
+        self._fetched_at = None
+        self._last_attempt = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._static is not None:
+            return self._static
+        if self.path:
+            with open(self.path) as jwks_file:
+                return json.load(jwks_file)
+        jsonurl = urlopen(self.url, timeout=self.timeout)
+        return json.loads(jsonurl.read())
+
+    def _index(self, jwks):
+        keys = {}
+        for key in jwks['keys']:
+            keys[key['kid']] = {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key.get('use', 'sig'),
+                'n': key['n'],
+                'e': key['e']
+            }
+        return keys
+
+    def _recently_attempted(self, now):
+        return (self._last_attempt is not None and
+                now - self._last_attempt < self.min_refetch_interval)
+
+    def refresh(self):
+        '''
+        Fetches the key set and swaps the index.
+        On failure the previous keys are kept and False is returned.
+        '''
+        with self._lock:
+            started = time.monotonic()
+            self._last_attempt = started
+            self.fetch_count += 1
+            try:
+                keys = self._index(self._load())
+            except Exception:
+                self.fetch_errors += 1
+                return False
+            finally:
+                elapsed = time.monotonic() - started
+                self.fetch_seconds += elapsed
+                record_timing('jwks', elapsed)
+                self._refreshing = False
+            self._keys = keys
+            self._fetched_at = time.monotonic()
+            return True
+
+    def _refresh_in_background(self, now):
+        if self._refreshing or self._recently_attempted(now):
+            return
+        self._refreshing = True
+        thread = threading.Thread(target=self.refresh, daemon=True)
+        thread.start()
+
+    def get_key(self, kid):
+        '''
+        Returns the JWK dict for kid or None if the IdP does not know it.
+        '''
+        now = time.monotonic()
+        if self._fetched_at is None:
+            if not self._recently_attempted(now):
+                self.refresh()
+        elif now - self._fetched_at >= self.ttl - self.refresh_ahead:
+            self._refresh_in_background(now)
+
+        key = self._keys.get(kid)
+        if key is None and self._fetched_at is not None \
+                and not self._recently_attempted(now):
+            self.refresh()
+            key = self._keys.get(kid)
+        return key
+
+    def set_keys(self, jwks):
+        '''
+        Pins a key set, e.g. a locally generated one.
+        Refreshes reload it instead of calling the IdP.
+        '''
+        with self._lock:
+            self._static = jwks
+            self._keys = self._index(jwks)
+            self._fetched_at = time.monotonic()
+
+
+jwks_store = JWKSStore(url=JWKS_URL, path=JWKS_FILE)
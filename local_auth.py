@@ -0,0 +1,90 @@
+import base64
+import os
+import time
+
+from Crypto.PublicKey import RSA
+from jose import jwt
+
+from config import AUTH0_DOMAIN, API_AUDIENCE, LOCAL_AUTH_KEY_FILE
+from jwks import jwks_store
+
+'''
+Offline auth
+Tokens are signed with a locally generated RSA key whose public half is
+installed in the jwks_store, so verify_decode_jwt checks them exactly
+like Auth0 tokens without any network access.
+'''
+
+LOCAL_KID = 'casting-agency-local'
+
+ROLE_PERMISSIONS = {
+    'casting_assistant': ['get:actors', 'get:movies'],
+    'casting_director': [
+        'get:actors', 'get:movies', 'create:actors', 'delete:actors',
+        'update:actors', 'update:movies'],
+    'executive_producer': [
+        'get:actors', 'get:movies', 'create:actors', 'delete:actors',
+        'update:actors', 'update:movies', 'create:movies', 'delete:movies']
+}
+
+_private_key = None
+
+
+def local_private_key():
+    '''
+    Generated once per process, or shared through LOCAL_AUTH_KEY_FILE
+    so several processes accept the same tokens.
+    '''
+    global _private_key
+    if _private_key is None:
+        if LOCAL_AUTH_KEY_FILE and os.path.exists(LOCAL_AUTH_KEY_FILE):
+            with open(LOCAL_AUTH_KEY_FILE) as key_file:
+                _private_key = RSA.import_key(key_file.read())
+        else:
+            _private_key = RSA.generate(2048)
+            if LOCAL_AUTH_KEY_FILE:
+                with open(LOCAL_AUTH_KEY_FILE, 'wb') as key_file:
+                    key_file.write(_private_key.export_key('PEM'))
+    return _private_key
+
+
+def b64_int(value):
+    raw = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def local_jwks():
+    key = local_private_key()
+    return {'keys': [{
+        'kty': 'RSA',
+        'kid': LOCAL_KID,
+        'use': 'sig',
+        'alg': 'RS256',
+        'n': b64_int(key.n),
+        'e': b64_int(key.e)
+    }]}
+
+
+def enable_offline_auth():
+    jwks_store.set_keys(local_jwks())
+
+
+def mint_token(role=None, permissions=None, sub=None, expires_in=3600):
+    '''
+    Signs an Auth0-shaped access token for a role of ROLE_PERMISSIONS
+    or an explicit permission list.
+    '''
+    if permissions is None:
+        permissions = ROLE_PERMISSIONS[role]
+    now = int(time.time())
+    claims = {
+        'iss': 'https://' + AUTH0_DOMAIN + '/',
+        'sub': sub or 'local|{}'.format(role or 'custom'),
+        'aud': API_AUDIENCE,
+        'iat': now,
+        'exp': now + expires_in,
+        'permissions': list(permissions)
+    }
+    private_pem = local_private_key().export_key('PEM').decode('ascii')
+    return jwt.encode(claims, private_pem, algorithm='RS256',
+                      headers={'kid': LOCAL_KID})
@@ -1,13 +1,46 @@
-from flask_script import Manager
+from flask_script import Manager, Command, Option
 from flask_migrate import Migrate, MigrateCommand
 
-from app import app
+from app import get_app
+from importer import import_file, rebuild_budget_stats
 from models import db
+from response_cache import bump_table_version
 
+app = get_app()
 migrate = Migrate(app, db)
 manager = Manager(app)
 
 manager.add_command('db', MigrateCommand)
 
+
+class ImportCommand(Command):
+    '''Load actors, movies and links from CSV/NDJSON files with COPY'''
+
+    option_list = (
+        Option('--actors', dest='actors', help='actors .csv/.ndjson file'),
+        Option('--movies', dest='movies', help='movies .csv/.ndjson file'),
+        Option('--links', dest='links',
+               help='movie_launch .csv/.ndjson file '
+                    '(Movie_id, Actor_id, movie_budget)'),
+    )
+
+    def run(self, actors, movies, links):
+        files = (('actors', actors), ('movies', movies), ('links', links))
+        if not any(path for kind, path in files):
+            print('nothing to import, pass --actors, --movies or --links')
+            return
+        connection = db.engine.raw_connection()
+        try:
+            for kind, path in files:
+                if path:
+                    import_file(connection, kind, path)
+            rebuild_budget_stats(connection)
+        finally:
+            connection.close()
+        bump_table_version('actors', 'movies', 'movie_launch')
+
+
+manager.add_command('import', ImportCommand())
+
 if __name__ == '__main__':
     manager.run()
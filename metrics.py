@@ -0,0 +1,297 @@
+import atexit
+import bisect
+import glob
+import json
+import os
+import threading
+import time
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from config import METRICS_DIR, METRICS_FLUSH_INTERVAL
+from db_pool import pool_status
+from jwks import jwks_store
+from models import db
+from rate_limit import in_flight
+from token_cache import token_cache
+
+'''
+Prometheus metrics
+Each process counts its requests in a latency histogram per method,
+route and status, and its SQL statements per route. /metrics renders
+them with the pool, JWKS and token cache counters in the Prometheus text
+format. With METRICS_DIR set every worker writes a snapshot there each
+METRICS_FLUSH_INTERVAL seconds and /metrics adds up the snapshots of all
+workers, gauges only from those still running.
+'''
+
+# seconds, the upper bounds of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                   5.0, 10.0)
+
+# name: help of the metrics read from the process wide counters
+PROCESS_COUNTERS = {
+    'db_pool_checkouts_total': 'Connections checked out of the pool.',
+    'db_pool_timeouts_total': 'Checkouts that timed out waiting.',
+    'db_pool_wait_seconds_total': 'Seconds spent waiting for a connection.',
+    'jwks_fetches_total': 'JWKS key set fetches.',
+    'jwks_fetch_errors_total': 'JWKS key set fetches that failed.',
+    'jwks_fetch_seconds_total': 'Seconds spent fetching the JWKS key set.',
+    'token_cache_hits_total': 'Bearer tokens found in the token cache.',
+    'token_cache_misses_total': 'Bearer tokens verified on a cache miss.'
+}
+PROCESS_GAUGES = {
+    'http_requests_in_flight': 'Requests being served, /health aside.',
+    'db_pool_size': 'Connections kept in the pool.',
+    'db_pool_checked_out': 'Connections checked out of the pool.',
+    'db_pool_overflow': 'Connections open beyond the pool size.'
+}
+
+
+class Metrics:
+    def __init__(self):
+        self.requests = {}
+        self.statements = {}
+        self._lock = threading.Lock()
+
+    def observe(self, method, route, status, seconds):
+        key = (method, route, status)
+        with self._lock:
+            observed = self.requests.get(key)
+            if observed is None:
+                observed = self.requests[key] = [
+                    [0] * (len(LATENCY_BUCKETS) + 1), 0.0, 0]
+            observed[0][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            observed[1] += seconds
+            observed[2] += 1
+
+    def count_statement(self, route):
+        with self._lock:
+            self.statements[route] = self.statements.get(route, 0) + 1
+
+    def snapshot(self, engine):
+        '''This process's metrics as a JSON serializable dict.'''
+        pool = pool_status(engine)
+        with self._lock:
+            return {
+                'pid': os.getpid(),
+                'requests': [list(key) + [list(observed[0])] + observed[1:]
+                             for key, observed in self.requests.items()],
+                'statements': list(self.statements.items()),
+                'counters': {
+                    'db_pool_checkouts_total': pool['checkouts'],
+                    'db_pool_timeouts_total': pool['timeouts'],
+                    'db_pool_wait_seconds_total': pool['wait_seconds_total'],
+                    'jwks_fetches_total': jwks_store.fetch_count,
+                    'jwks_fetch_errors_total': jwks_store.fetch_errors,
+                    'jwks_fetch_seconds_total': jwks_store.fetch_seconds,
+                    'token_cache_hits_total': token_cache.hits,
+                    'token_cache_misses_total': token_cache.misses
+                },
+                'gauges': {
+                    'http_requests_in_flight': in_flight.count,
+                    'db_pool_size': pool.get('size', 0),
+                    'db_pool_checked_out': pool.get('checked_out', 0),
+                    'db_pool_overflow': pool.get('overflow', 0)
+                }
+            }
+
+
+metrics = Metrics()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_route_statement(conn, cursor, statement, parameters, context,
+                          executemany):
+    metrics.count_statement(request_route() if has_request_context()
+                            else 'none')
+
+
+def request_route():
+    '''The URL rule of the request, so ids do not make new series.'''
+    rule = request.url_rule
+    return rule.rule if rule is not None else 'unmatched'
+
+
+def snapshot_path(directory, pid):
+    return os.path.join(directory, 'metrics-{}.json'.format(pid))
+
+
+def write_snapshot(directory, snapshot):
+    path = snapshot_path(directory, snapshot['pid'])
+    temporary = path + '.tmp'
+    with open(temporary, 'w') as snapshot_file:
+        json.dump(snapshot, snapshot_file)
+    os.replace(temporary, path)
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def read_snapshots(directory, own):
+    '''own plus the snapshots of the other processes in directory.'''
+    snapshots = [own]
+    for path in glob.glob(os.path.join(directory, 'metrics-*.json')):
+        try:
+            with open(path) as snapshot_file:
+                snapshot = json.load(snapshot_file)
+        except (OSError, ValueError):
+            continue
+        if snapshot['pid'] != own['pid']:
+            snapshots.append(snapshot)
+    return snapshots
+
+
+def merge_snapshots(snapshots):
+    '''Sums the snapshots, gauges of exited processes are left out.'''
+    requests, statements = {}, {}
+    counters = dict.fromkeys(PROCESS_COUNTERS, 0)
+    gauges = dict.fromkeys(PROCESS_GAUGES, 0)
+    own = os.getpid()
+    for snapshot in snapshots:
+        for method, route, status, buckets, total, count in \
+                snapshot['requests']:
+            merged = requests.setdefault(
+                (method, route, status), [[0] * len(buckets), 0.0, 0])
+            merged[0] = [a + b for a, b in zip(merged[0], buckets)]
+            merged[1] += total
+            merged[2] += count
+        for route, count in snapshot['statements']:
+            statements[route] = statements.get(route, 0) + count
+        for name, value in snapshot['counters'].items():
+            counters[name] += value
+        if snapshot['pid'] == own or process_alive(snapshot['pid']):
+            for name, value in snapshot['gauges'].items():
+                gauges[name] += value
+    return requests, statements, counters, gauges
+
+
+def escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace(
+        '\n', r'\n')
+
+
+def labels(**values):
+    return '{' + ','.join('{}="{}"'.format(name, escape(value))
+                          for name, value in values.items()) + '}'
+
+
+def render(requests, statements, counters, gauges):
+    '''Prometheus text exposition format 0.0.4.'''
+    lines = [
+        '# HELP http_request_duration_seconds Request latency.',
+        '# TYPE http_request_duration_seconds histogram'
+    ]
+    bounds = [str(bound) for bound in LATENCY_BUCKETS] + ['+Inf']
+    for (method, route, status), (buckets, total, count) in sorted(
+            requests.items()):
+        cumulative = 0
+        for bound, bucket in zip(bounds, buckets):
+            cumulative += bucket
+            lines.append('http_request_duration_seconds_bucket{} {}'.format(
+                labels(method=method, route=route, status=status,
+                       le=bound), cumulative))
+        series = labels(method=method, route=route, status=status)
+        lines.append('http_request_duration_seconds_sum{} {}'.format(
+            series, round(total, 6)))
+        lines.append('http_request_duration_seconds_count{} {}'.format(
+            series, count))
+
+    lines.extend(['# HELP sql_statements_total SQL statements run.',
+                  '# TYPE sql_statements_total counter'])
+    lines.extend('sql_statements_total{} {}'.format(labels(route=route),
+                                                    count)
+                 for route, count in sorted(statements.items()))
+
+    for name, help_text in PROCESS_COUNTERS.items():
+        lines.extend(['# HELP {} {}'.format(name, help_text),
+                      '# TYPE {} counter'.format(name),
+                      '{} {}'.format(name, round(counters[name], 6))])
+    for name, help_text in PROCESS_GAUGES.items():
+        lines.extend(['# HELP {} {}'.format(name, help_text),
+                      '# TYPE {} gauge'.format(name),
+                      '{} {}'.format(name, gauges[name])])
+
+    lookups = (counters['token_cache_hits_total'] +
+               counters['token_cache_misses_total'])
+    lines.extend([
+        '# HELP token_cache_hit_ratio Share of bearer tokens found in the '
+        'token cache.',
+        '# TYPE token_cache_hit_ratio gauge',
+        'token_cache_hit_ratio {}'.format(round(
+            counters['token_cache_hits_total'] / lookups, 6)
+            if lookups else 0)
+    ])
+    return '\n'.join(lines) + '\n'
+
+
+class SnapshotWriter:
+    '''Writes this worker's snapshot every interval from a daemon thread.'''
+
+    def __init__(self):
+        self.pid = None
+        self._lock = threading.Lock()
+
+    def start(self, app, directory, interval):
+        # started by the first request of each (forked) worker
+        with self._lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+        engine = db.get_engine(app)
+
+        def flush():
+            write_snapshot(directory, metrics.snapshot(engine))
+
+        def run():
+            while True:
+                time.sleep(interval)
+                flush()
+
+        threading.Thread(target=run, daemon=True).start()
+        atexit.register(flush)
+
+
+snapshot_writer = SnapshotWriter()
+
+
+def metrics_response(engine):
+    snapshot = metrics.snapshot(engine)
+    directory = current_app.config.get('METRICS_DIR', METRICS_DIR)
+    snapshots = [snapshot]
+    if directory:
+        write_snapshot(directory, snapshot)
+        snapshots = read_snapshots(directory, snapshot)
+    return current_app.response_class(
+        render(*merge_snapshots(snapshots)),
+        mimetype='text/plain; version=0.0.4')
+
+
+def init_metrics(app):
+    @app.before_request
+    def start_metrics():
+        g.metrics_started = time.perf_counter()
+        directory = current_app.config.get('METRICS_DIR', METRICS_DIR)
+        if directory:
+            snapshot_writer.start(current_app._get_current_object(),
+                                  directory, current_app.config.get(
+                                      'METRICS_FLUSH_INTERVAL',
+                                      METRICS_FLUSH_INTERVAL))
+
+    @app.after_request
+    def observe_request(response):
+        started = g.get('metrics_started')
+        if started is not None:
+            metrics.observe(request.method, request_route(),
+                            str(response.status_code),
+                            time.perf_counter() - started)
+        return response
@@ -0,0 +1,51 @@
+"""movie_launch composite primary key, reverse index and cascades
+
+Revision ID: 3b1f2c4d5e6a
+Revises:
+Create Date: 2026-10-17 09:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '3b1f2c4d5e6a'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # links without both ids or duplicated links cannot satisfy the key
+    op.execute('DELETE FROM movie_launch '
+               'WHERE "Movie_id" IS NULL OR "Actor_id" IS NULL')
+    op.execute('DELETE FROM movie_launch a USING movie_launch b '
+               'WHERE a.ctid < b.ctid '
+               'AND a."Movie_id" = b."Movie_id" '
+               'AND a."Actor_id" = b."Actor_id"')
+
+    op.drop_constraint('movie_launch_Movie_id_fkey', 'movie_launch',
+                       type_='foreignkey')
+    op.drop_constraint('movie_launch_Actor_id_fkey', 'movie_launch',
+                       type_='foreignkey')
+    op.create_foreign_key('movie_launch_Movie_id_fkey', 'movie_launch',
+                          'movies', ['Movie_id'], ['id'], ondelete='CASCADE')
+    op.create_foreign_key('movie_launch_Actor_id_fkey', 'movie_launch',
+                          'actors', ['Actor_id'], ['id'], ondelete='CASCADE')
+    op.create_primary_key('movie_launch_pkey', 'movie_launch',
+                          ['Movie_id', 'Actor_id'])
+    op.create_index('ix_movie_launch_Actor_id', 'movie_launch',
+                    ['Actor_id'])
+
+
+def downgrade():
+    op.drop_index('ix_movie_launch_Actor_id', table_name='movie_launch')
+    op.drop_constraint('movie_launch_pkey', 'movie_launch', type_='primary')
+    op.drop_constraint('movie_launch_Movie_id_fkey', 'movie_launch',
+                       type_='foreignkey')
+    op.drop_constraint('movie_launch_Actor_id_fkey', 'movie_launch',
+                       type_='foreignkey')
+    op.create_foreign_key('movie_launch_Movie_id_fkey', 'movie_launch',
+                          'movies', ['Movie_id'], ['id'])
+    op.create_foreign_key('movie_launch_Actor_id_fkey', 'movie_launch',
+                          'actors', ['Actor_id'], ['id'])
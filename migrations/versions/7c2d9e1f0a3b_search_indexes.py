@@ -0,0 +1,34 @@
+"""trigram and prefix indexes for actor name and movie title search
+
+Revision ID: 7c2d9e1f0a3b
+Revises: 3b1f2c4d5e6a
+Create Date: 2026-10-17 10:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '7c2d9e1f0a3b'
+down_revision = '3b1f2c4d5e6a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.execute('CREATE INDEX ix_actors_name_trgm ON actors '
+               'USING gin (lower(name) gin_trgm_ops)')
+    op.execute('CREATE INDEX ix_actors_name_prefix ON actors '
+               '(lower(name) text_pattern_ops)')
+    op.execute('CREATE INDEX ix_movies_title_trgm ON movies '
+               'USING gin (lower(title) gin_trgm_ops)')
+    op.execute('CREATE INDEX ix_movies_title_prefix ON movies '
+               '(lower(title) text_pattern_ops)')
+
+
+def downgrade():
+    op.drop_index('ix_movies_title_prefix', table_name='movies')
+    op.drop_index('ix_movies_title_trgm', table_name='movies')
+    op.drop_index('ix_actors_name_prefix', table_name='actors')
+    op.drop_index('ix_actors_name_trgm', table_name='actors')
@@ -0,0 +1,32 @@
+"""b-tree indexes for list filters and sort keys
+
+Revision ID: 9e4a6b8c0d2f
+Revises: 7c2d9e1f0a3b
+Create Date: 2026-10-17 11:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '9e4a6b8c0d2f'
+down_revision = '7c2d9e1f0a3b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_actors_age_id', 'actors', ['age', 'id'])
+    op.create_index('ix_actors_gender_age', 'actors', ['gender', 'age'])
+    op.create_index('ix_actors_name_id', 'actors', ['name', 'id'])
+    op.create_index('ix_movies_release_date_id', 'movies',
+                    ['release_date', 'id'])
+    op.create_index('ix_movies_title_id', 'movies', ['title', 'id'])
+
+
+def downgrade():
+    op.drop_index('ix_movies_title_id', table_name='movies')
+    op.drop_index('ix_movies_release_date_id', table_name='movies')
+    op.drop_index('ix_actors_name_id', table_name='actors')
+    op.drop_index('ix_actors_gender_age', table_name='actors')
+    op.drop_index('ix_actors_age_id', table_name='actors')
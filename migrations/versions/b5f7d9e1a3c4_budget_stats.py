@@ -0,0 +1,75 @@
+"""budget summary tables per movie, actor and release month
+
+Revision ID: b5f7d9e1a3c4
+Revises: 9e4a6b8c0d2f
+Create Date: 2026-10-17 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b5f7d9e1a3c4'
+down_revision = '9e4a6b8c0d2f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'movie_budget_stats',
+        sa.Column('movie_id', sa.Integer(), nullable=False),
+        sa.Column('release_month', sa.Date(), nullable=True),
+        sa.Column('total_budget', sa.Float(), nullable=False),
+        sa.Column('actor_count', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['movie_id'], ['movies.id'],
+                                ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('movie_id')
+    )
+    op.create_index('ix_movie_budget_stats_release_month',
+                    'movie_budget_stats', ['release_month'])
+    op.create_table(
+        'actor_budget_stats',
+        sa.Column('actor_id', sa.Integer(), nullable=False),
+        sa.Column('total_budget', sa.Float(), nullable=False),
+        sa.Column('movie_count', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['actor_id'], ['actors.id'],
+                                ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('actor_id')
+    )
+    op.create_table(
+        'month_budget_stats',
+        sa.Column('release_month', sa.Date(), nullable=False),
+        sa.Column('total_budget', sa.Float(), nullable=False),
+        sa.Column('movie_count', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('release_month')
+    )
+
+    op.execute(
+        'INSERT INTO movie_budget_stats '
+        '(movie_id, release_month, total_budget, actor_count) '
+        "SELECT m.id, date_trunc('month', m.release_date)::date, "
+        'COALESCE(SUM(l.movie_budget), 0), COUNT(l."Actor_id") '
+        'FROM movies m JOIN movie_launch l ON l."Movie_id" = m.id '
+        'GROUP BY m.id, m.release_date')
+    op.execute(
+        'INSERT INTO actor_budget_stats '
+        '(actor_id, total_budget, movie_count) '
+        'SELECT l."Actor_id", COALESCE(SUM(l.movie_budget), 0), '
+        'COUNT(l."Movie_id") FROM movie_launch l '
+        'JOIN movies m ON m.id = l."Movie_id" GROUP BY l."Actor_id"')
+    op.execute(
+        'INSERT INTO month_budget_stats '
+        '(release_month, total_budget, movie_count) '
+        'SELECT release_month, SUM(total_budget), COUNT(*) '
+        'FROM movie_budget_stats WHERE release_month IS NOT NULL '
+        'GROUP BY release_month')
+
+
+def downgrade():
+    op.drop_table('month_budget_stats')
+    op.drop_table('actor_budget_stats')
+    op.drop_index('ix_movie_budget_stats_release_month',
+                  table_name='movie_budget_stats')
+    op.drop_table('movie_budget_stats')
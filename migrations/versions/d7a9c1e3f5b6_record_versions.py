@@ -0,0 +1,28 @@
+"""version columns for optimistic concurrency on actors and movies
+
+Revision ID: d7a9c1e3f5b6
+Revises: b5f7d9e1a3c4
+Create Date: 2026-10-17 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd7a9c1e3f5b6'
+down_revision = 'b5f7d9e1a3c4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('actors', sa.Column(
+        'version', sa.Integer(), nullable=False, server_default='1'))
+    op.add_column('movies', sa.Column(
+        'version', sa.Integer(), nullable=False, server_default='1'))
+
+
+def downgrade():
+    op.drop_column('movies', 'version')
+    op.drop_column('actors', 'version')
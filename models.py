@@ -1,37 +1,86 @@
 import os
 from sqlalchemy import Column, String, Integer, create_engine, Date, Float
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import and_, case, func, literal, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm.exc import StaleDataError
 import json
 from datetime import date
-from config import database_name, database_path
+from config import (database_name, database_path, BULK_CHUNK_SIZE,
+                    DB_PROFILE, DB_PROFILES, REPLICA_DATABASE_URL)
+from db_pool import engine_options
+from record_cache import record_cache
+from replica import REPLICA_BIND, RoutingSQLAlchemy, init_replica
+from response_cache import bump_table_version
 
 database_name = database_name
 database_path = database_path
 
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 
 
-def db_init(app):
-    app.config["SQLALCHEMY_DATABASE_URI"] = database_path
+def db_init(app, test_config=None):
+    test_config = test_config or {}
+    profile = test_config.get('DB_PROFILE', DB_PROFILE)
+    if profile not in DB_PROFILES:
+        raise ValueError('unknown DB_PROFILE {}'.format(profile))
+    database_uri = test_config.get(
+        'SQLALCHEMY_DATABASE_URI', DB_PROFILES[profile])
+    app.config["SQLALCHEMY_DATABASE_URI"] = database_uri
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_uri)
+    replica_uri = test_config.get('REPLICA_DATABASE_URI',
+                                  REPLICA_DATABASE_URL)
+    if replica_uri:
+        init_replica(app, replica_uri)
     db.app = app
     db.init_app(app)
     # uncomment the first time for run
     # db.create_all()
 
 
+def db_engines(app=None):
+    '''The primary engine, then the replica's when there is one.'''
+    app = db.get_app(app)
+    engines = [db.get_engine(app)]
+    if REPLICA_BIND in (app.config.get('SQLALCHEMY_BINDS') or {}):
+        engines.append(db.get_engine(app, bind=REPLICA_BIND))
+    return engines
+
+
+def db_create():
+    '''Creates the tables, and on Postgres the pg_trgm fuzzy search needs.'''
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        db.session.commit()
+    db.create_all()
+
+
 def db_reboot():
     db.drop_all()
-    db.create_all()
+    db_create()
     db_init_rows()
+    record_cache.clear()
+    bump_table_version('actors', 'movies', 'movie_launch')
 
 
 class Actor(db.Model):
     __tablename__ = 'actors'
+    __table_args__ = (
+        db.Index('ix_actors_age_id', 'age', 'id'),
+        db.Index('ix_actors_gender_age', 'gender', 'age'),
+        db.Index('ix_actors_name_id', 'name', 'id'),
+    )
     id = Column(Integer, primary_key=True)
     name = Column(String)
     gender = Column(String)
     age = Column(Integer)
+    # bumped by every update, clients may send it back to detect conflicts
+    version = Column(Integer, nullable=False, default=1, server_default='1')
+
+    __mapper_args__ = {'version_id_col': version}
+
+    # accepted by ?fields=
+    FIELDS = ('id', 'name', 'gender', 'age', 'version')
 
     def __init__(self, name, gender, age):
         self.name = name
@@ -47,34 +96,56 @@ class Actor(db.Model):
     def delete(self):
         delete(self)
 
-    def format(self):
-        return {
-            'id': self.id,
-            'name': self.name,
-            'gender': self.gender,
-            'age': self.age
-        }
+    def format(self, include=(), fields=None):
+        if fields:
+            actor = {field: getattr(self, field) for field in fields}
+        else:
+            actor = {
+                'id': self.id,
+                'name': self.name,
+                'gender': self.gender,
+                'age': self.age,
+                'version': self.version
+            }
+        if 'movies' in include:
+            actor['movies'] = [movie.format() for movie in self.movies]
+        return actor
 
 
 Movie_Launch = db.Table(
     'movie_launch', db.Model.metadata, db.Column(
-        'Movie_id', db.Integer, db.ForeignKey('movies.id')), db.Column(
-            'Actor_id', db.Integer, db.ForeignKey('actors.id')), db.Column(
-                'movie_budget', db.Float))
+        'Movie_id', db.Integer, db.ForeignKey(
+            'movies.id', ondelete='CASCADE'), primary_key=True), db.Column(
+        'Actor_id', db.Integer, db.ForeignKey(
+            'actors.id', ondelete='CASCADE'), primary_key=True,
+        index=True), db.Column(
+        'movie_budget', db.Float))
 
 
 class Movie(db.Model):
     __tablename__ = 'movies'
+    __table_args__ = (
+        db.Index('ix_movies_release_date_id', 'release_date', 'id'),
+        db.Index('ix_movies_title_id', 'title', 'id'),
+    )
 
     id = Column(Integer, primary_key=True)
     title = Column(String)
     release_date = Column(Date)
+    version = Column(Integer, nullable=False, default=1, server_default='1')
+
+    __mapper_args__ = {'version_id_col': version}
+
+    # accepted by ?fields=
+    FIELDS = ('id', 'title', 'release_date', 'version')
+
     actors = db.relationship(
         'Actor',
         secondary=Movie_Launch,
+        passive_deletes=True,
         backref=db.backref(
-            'movie_launch',
-            lazy='joined'))
+            'movies',
+            passive_deletes=True))
 
     def __init__(self, title, release_date):
         self.title = title
@@ -89,29 +160,364 @@ class Movie(db.Model):
     def delete(self):
         delete(self)
 
-    def format(self):
-        return {
-            'id': self.id,
-            'title': self.title,
-            'release_date': self.release_date
-        }
+    def format(self, include=(), fields=None):
+        if fields:
+            movie = {field: getattr(self, field) for field in fields}
+        else:
+            movie = {
+                'id': self.id,
+                'title': self.title,
+                'release_date': self.release_date,
+                'version': self.version
+            }
+        if 'actors' in include:
+            movie['actors'] = [actor.format() for actor in self.actors]
+        return movie
+
+
+'''BUDGET SUMMARY TABLES'''
+
+# kept in step with movie_launch by refresh_budget_stats
+Movie_Budget_Stats = db.Table(
+    'movie_budget_stats', db.Model.metadata, db.Column(
+        'movie_id', db.Integer, db.ForeignKey(
+            'movies.id', ondelete='CASCADE'), primary_key=True), db.Column(
+        'release_month', db.Date, index=True), db.Column(
+        'total_budget', db.Float, nullable=False), db.Column(
+        'actor_count', db.Integer, nullable=False))
+
+Actor_Budget_Stats = db.Table(
+    'actor_budget_stats', db.Model.metadata, db.Column(
+        'actor_id', db.Integer, db.ForeignKey(
+            'actors.id', ondelete='CASCADE'), primary_key=True), db.Column(
+        'total_budget', db.Float, nullable=False), db.Column(
+        'movie_count', db.Integer, nullable=False))
+
+Month_Budget_Stats = db.Table(
+    'month_budget_stats', db.Model.metadata, db.Column(
+        'release_month', db.Date, primary_key=True), db.Column(
+        'total_budget', db.Float, nullable=False), db.Column(
+        'movie_count', db.Integer, nullable=False))
+
+
+def first_of_month(day):
+    return day.replace(day=1) if day else None
+
+
+def release_months(movie_ids):
+    '''Months the summary rows of movie_ids currently count them in.'''
+    return {month for month, in db.session.execute(
+        select([Movie_Budget_Stats.c.release_month]).where(
+            Movie_Budget_Stats.c.movie_id.in_(movie_ids)))}
+
+
+def refresh_budget_stats(movie_ids=(), actor_ids=(), months=()):
+    '''
+    Recomputes the summary rows of the given movies and actors, and of the
+    release months they move in or out of, in the current transaction.
+    Deleting movies cascades to their summary rows, so their months have
+    to be read beforehand with release_months() and passed as months.
+    '''
+    movie_ids, actor_ids = list(set(movie_ids)), list(set(actor_ids))
+    db.session.flush()
+    months = set(months)
+
+    if movie_ids:
+        months.update(release_months(movie_ids))
+        db.session.execute(Movie_Budget_Stats.delete().where(
+            Movie_Budget_Stats.c.movie_id.in_(movie_ids)))
+        totals = db.session.execute(select([
+            Movie.id, Movie.release_date,
+            func.coalesce(func.sum(Movie_Launch.c.movie_budget), 0),
+            func.count(Movie_Launch.c.Actor_id)]).select_from(
+            Movie.__table__.join(
+                Movie_Launch, Movie_Launch.c.Movie_id == Movie.id)).where(
+            Movie.id.in_(movie_ids)).group_by(
+            Movie.id, Movie.release_date)).fetchall()
+        rows = [{
+            'movie_id': movie_id,
+            'release_month': first_of_month(release_date),
+            'total_budget': total_budget,
+            'actor_count': actor_count
+        } for movie_id, release_date, total_budget, actor_count in totals]
+        if rows:
+            db.session.execute(Movie_Budget_Stats.insert(), rows)
+        months.update(row['release_month'] for row in rows)
+
+    if actor_ids:
+        db.session.execute(Actor_Budget_Stats.delete().where(
+            Actor_Budget_Stats.c.actor_id.in_(actor_ids)))
+        totals = db.session.execute(select([
+            Movie_Launch.c.Actor_id,
+            func.coalesce(func.sum(Movie_Launch.c.movie_budget), 0),
+            func.count(Movie_Launch.c.Movie_id)]).select_from(
+            Movie_Launch.join(
+                Movie.__table__, Movie_Launch.c.Movie_id == Movie.id)).where(
+            Movie_Launch.c.Actor_id.in_(actor_ids)).group_by(
+            Movie_Launch.c.Actor_id)).fetchall()
+        rows = [{
+            'actor_id': actor_id,
+            'total_budget': total_budget,
+            'movie_count': movie_count
+        } for actor_id, total_budget, movie_count in totals]
+        if rows:
+            db.session.execute(Actor_Budget_Stats.insert(), rows)
+
+    months.discard(None)
+    if months:
+        db.session.execute(Month_Budget_Stats.delete().where(
+            Month_Budget_Stats.c.release_month.in_(months)))
+        totals = db.session.execute(select([
+            Movie_Budget_Stats.c.release_month,
+            func.sum(Movie_Budget_Stats.c.total_budget),
+            func.count()]).where(
+            Movie_Budget_Stats.c.release_month.in_(months)).group_by(
+            Movie_Budget_Stats.c.release_month)).fetchall()
+        rows = [{
+            'release_month': release_month,
+            'total_budget': total_budget,
+            'movie_count': movie_count
+        } for release_month, total_budget, movie_count in totals]
+        if rows:
+            db.session.execute(Month_Budget_Stats.insert(), rows)
+
+
+def linked_ids(record):
+    '''Ids on the other side of movie_launch for an Actor or a Movie.'''
+    if isinstance(record, Movie):
+        column, other = Movie_Launch.c.Movie_id, Movie_Launch.c.Actor_id
+    else:
+        column, other = Movie_Launch.c.Actor_id, Movie_Launch.c.Movie_id
+    return [linked for linked, in db.session.execute(
+        select([other]).where(column == record.id))]
+
+
+def stats_keys(record, linked=()):
+    if isinstance(record, Movie):
+        return {'movie_ids': [record.id], 'actor_ids': linked,
+                'months': release_months([record.id])}
+    return {'movie_ids': linked, 'actor_ids': [record.id]}
 
 
 '''CRUD OPERATIONS'''
 
 
+def dialect_name():
+    return db.session.get_bind().dialect.name
+
+
 def insert(self):
     db.session.add(self)
     db.session.commit()
+    bump_table_version(self.__tablename__)
 
 
 def update(self):
+    if isinstance(self, Movie):
+        # release_date decides the release month of the movie's budget
+        refresh_budget_stats(movie_ids=[self.id])
     db.session.commit()
+    record_cache.invalidate(self.__tablename__, [self.id])
+    bump_table_version(self.__tablename__)
 
 
 def delete(self):
+    record_id = self.id
+    keys = stats_keys(self, linked_ids(self))
     db.session.delete(self)
+    refresh_budget_stats(**keys)
     db.session.commit()
+    record_cache.invalidate(self.__tablename__, [record_id])
+    bump_table_version(self.__tablename__, 'movie_launch')
+
+
+def bulk_insert(model, rows):
+    '''
+    Inserts rows in one transaction and returns their ids in input order.
+    Postgres gets chunked multi-row INSERT ... RETURNING id, sequence
+    values are assigned in VALUES order so sorting restores input order.
+    '''
+    table = model.__table__
+    ids = []
+    try:
+        if dialect_name() == 'postgresql':
+            for start in range(0, len(rows), BULK_CHUNK_SIZE):
+                chunk = rows[start:start + BULK_CHUNK_SIZE]
+                result = db.session.execute(
+                    table.insert().values(chunk).returning(table.c.id))
+                ids.extend(sorted(row[0] for row in result))
+        else:
+            for row in rows:
+                result = db.session.execute(table.insert().values(**row))
+                ids.append(result.inserted_primary_key[0])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    bump_table_version(table.name)
+    return ids
+
+
+def current_versions(table, ids, lock=False):
+    '''{id: version} of the ids that exist.'''
+    query = select([table.c.id, table.c.version]).where(table.c.id.in_(ids))
+    if lock:
+        query = query.with_for_update()
+    return dict(db.session.execute(query).fetchall())
+
+
+def bulk_update(model, changes, versions, partial=False):
+    '''
+    Applies {id: {column: value}} with one UPDATE ... WHERE id IN (...),
+    every column is set through CASE id WHEN ... THEN ... so each row gets
+    its own value, and version is bumped. Rows listed in versions are only
+    updated while their version still matches.
+    Returns ({id: new version}, conflicting ids, missing ids). Unless
+    partial, nothing is written when an id conflicts or is missing.
+    '''
+    table = model.__table__
+    ids = list(changes)
+    values = {table.c.version: table.c.version + 1}
+    for column in {name for row in changes.values() for name in row}:
+        column = table.c[column]
+        values[column] = case(
+            {record_id: literal(row[column.name], column.type)
+             for record_id, row in changes.items() if column.name in row},
+            value=table.c.id, else_=column)
+    condition = table.c.id.in_(ids)
+    if versions:
+        condition = and_(condition, table.c.version == case(
+            {record_id: literal(version)
+             for record_id, version in versions.items()},
+            value=table.c.id, else_=table.c.version))
+    statement = table.update().where(condition).values(values)
+
+    try:
+        if dialect_name() == 'postgresql':
+            updated = dict(db.session.execute(
+                statement.returning(table.c.id, table.c.version)).fetchall())
+            conflicts, missing = [], []
+            if len(updated) < len(ids):
+                current = current_versions(table, ids)
+                missing = [record_id for record_id in ids
+                           if record_id not in current]
+                conflicts = [record_id for record_id in ids if
+                             record_id in current and record_id not in updated]
+        else:
+            # without RETURNING the versions are read, and locked where the
+            # database can, before the UPDATE
+            current = current_versions(table, ids, lock=True)
+            missing = [record_id for record_id in ids
+                       if record_id not in current]
+            conflicts = [record_id for record_id in ids
+                         if record_id in current and record_id in versions and
+                         current[record_id] != versions[record_id]]
+            updated = {record_id: current[record_id] + 1 for record_id in ids
+                       if record_id in current and record_id not in conflicts}
+            if updated and (partial or not (conflicts or missing)):
+                if db.session.execute(statement).rowcount != len(updated):
+                    raise StaleDataError(
+                        'rows of {} changed during the update'.format(
+                            table.name))
+        if (conflicts or missing) and not partial:
+            db.session.rollback()
+            return {}, conflicts, missing
+        if model is Movie and updated:
+            # release_date decides the release month of the movie's budget
+            refresh_budget_stats(movie_ids=list(updated))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    record_cache.invalidate(table.name, updated)
+    bump_table_version(table.name)
+    return updated, conflicts, missing
+
+
+def bulk_delete(model, ids):
+    '''
+    Deletes ids with one DELETE ... WHERE id IN (...), RETURNING id on
+    Postgres, refreshes the budget stats of their links and returns the
+    deleted ids.
+    '''
+    table = model.__table__
+    if model is Movie:
+        column, other = Movie_Launch.c.Movie_id, Movie_Launch.c.Actor_id
+    else:
+        column, other = Movie_Launch.c.Actor_id, Movie_Launch.c.Movie_id
+    statement = table.delete().where(table.c.id.in_(ids))
+    try:
+        linked = [linked for linked, in db.session.execute(
+            select([other]).distinct().where(column.in_(ids)))]
+        if model is Movie:
+            keys = {'actor_ids': linked, 'months': release_months(ids)}
+        else:
+            keys = {'movie_ids': linked}
+        if dialect_name() == 'postgresql':
+            deleted = [record_id for record_id, in db.session.execute(
+                statement.returning(table.c.id))]
+        else:
+            deleted = [record_id for record_id, in db.session.execute(
+                select([table.c.id]).where(table.c.id.in_(ids)))]
+            db.session.execute(statement)
+        if model is Movie:
+            keys['movie_ids'] = deleted
+        else:
+            keys['actor_ids'] = deleted
+        refresh_budget_stats(**keys)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    record_cache.invalidate(table.name, deleted)
+    bump_table_version(table.name, 'movie_launch')
+    return deleted
+
+
+def attach_actors(movie_id, budgets):
+    '''
+    Links actors to a movie in one transaction.
+    budgets maps actor id to movie_budget, existing links are updated.
+    '''
+    rows = [{
+        'Movie_id': movie_id,
+        'Actor_id': actor_id,
+        'movie_budget': movie_budget
+    } for actor_id, movie_budget in budgets.items()]
+    try:
+        if dialect_name() == 'postgresql':
+            statement = pg_insert(Movie_Launch).values(rows)
+            statement = statement.on_conflict_do_update(
+                index_elements=[Movie_Launch.c.Movie_id,
+                                Movie_Launch.c.Actor_id],
+                set_={'movie_budget': statement.excluded.movie_budget})
+            db.session.execute(statement)
+        else:
+            db.session.execute(Movie_Launch.delete().where(and_(
+                Movie_Launch.c.Movie_id == movie_id,
+                Movie_Launch.c.Actor_id.in_(list(budgets)))))
+            db.session.execute(Movie_Launch.insert(), rows)
+        refresh_budget_stats(movie_ids=[movie_id], actor_ids=list(budgets))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    bump_table_version(Movie_Launch.name)
+
+
+def detach_actors(movie_id, actor_ids):
+    '''Unlinks actors from a movie, returns the number of links removed.'''
+    try:
+        result = db.session.execute(Movie_Launch.delete().where(and_(
+            Movie_Launch.c.Movie_id == movie_id,
+            Movie_Launch.c.Actor_id.in_(actor_ids))))
+        refresh_budget_stats(movie_ids=[movie_id], actor_ids=actor_ids)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    bump_table_version(Movie_Launch.name)
+    return result.rowcount
 
 
 ''' Mock Data'''
@@ -147,6 +553,13 @@ def db_init_rows():
         release_date=date.today()
     ))
 
+    actor1.insert()
+    actor2.insert()
+    actor3.insert()
+    movie1.insert()
+    movie2.insert()
+    movie3.insert()
+
     movie_launch1 = Movie_Launch.insert().values(
         Movie_id=movie1.id,
         Actor_id=actor1.id,
@@ -165,13 +578,9 @@ def db_init_rows():
         movie_budget=10000000000
     )
 
-    actor1.insert()
-    actor2.insert()
-    actor3.insert()
-    movie1.insert()
-    movie2.insert()
-    movie3.insert()
     db.session.execute(movie_launch1)
     db.session.execute(movie_launch2)
     db.session.execute(movie_launch3)
+    refresh_budget_stats(movie_ids=[movie1.id, movie2.id, movie3.id],
+                         actor_ids=[actor1.id, actor2.id, actor3.id])
     db.session.commit()
@@ -0,0 +1,218 @@
+import base64
+import json
+from collections import namedtuple
+from datetime import date
+
+from flask import abort
+from sqlalchemy import tuple_
+
+from config import PAGE_SIZE, MAX_PAGE_SIZE
+
+'''
+Pagination helpers
+LIMIT/OFFSET and keyset (?cursor=) pagination executed in the database
+'''
+
+Sort = namedtuple('Sort', ['key', 'column', 'descending'])
+
+# largest INTEGER id and BIGINT offset the database takes as a parameter
+MAX_ID = 2 ** 31 - 1
+MAX_OFFSET = 2 ** 63 - 1
+
+
+def encode_cursor(last_id, sort=None, last_value=None):
+    data = {'id': last_id}
+    if sort is not None and sort.key != 'id':
+        if isinstance(last_value, date):
+            last_value = last_value.isoformat()
+        data['s'] = sort.key
+        data['v'] = last_value
+    raw = json.dumps(data, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    '''Returns {'id': last_id} plus 's' and 'v' for non-id sorts.'''
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        data['id'] = int(data['id'])
+    except (ValueError, TypeError, KeyError, OverflowError):
+        abort(400, {'message': 'invalid cursor.'})
+    if not 0 <= data['id'] <= MAX_ID:
+        abort(400, {'message': 'invalid cursor.'})
+    return data
+
+
+def get_page_size(request):
+    page_size = request.args.get('page_size', PAGE_SIZE, type=int)
+    if page_size < 1:
+        abort(400, {'message': 'page_size must be positive.'})
+    return min(page_size, MAX_PAGE_SIZE)
+
+
+def get_page(request, page_size):
+    '''
+    (page, OFFSET) of ?page=, 400 when it is not a page the database
+    can skip to.
+    '''
+    page = request.args.get('page', 1, type=int)
+    if page < 1:
+        abort(400, {'message': 'page must be positive.'})
+    if page * page_size >= MAX_OFFSET:
+        abort(400, {'message': 'page is out of range.'})
+    return page, (page - 1) * page_size
+
+
+def get_sort(request, sorts):
+    '''
+    Parses ?sort=key or ?sort=-key against a whitelist
+    mapping sort keys to columns.
+    '''
+    key = request.args.get('sort', 'id')
+    descending = key.startswith('-')
+    key = key.lstrip('-')
+    if key not in sorts:
+        abort(400, {'message': 'sort must be one of {}.'.format(
+            ', '.join(sorted(sorts)))})
+    return Sort(key, sorts[key], descending)
+
+
+def cursor_value(sort, cursor):
+    '''The sort value of the cursor, 400 when it does not fit the column.'''
+    if cursor.get('s') != sort.key:
+        abort(400, {'message': 'cursor does not match sort.'})
+    if 'v' not in cursor:
+        abort(400, {'message': 'invalid cursor.'})
+    last_value = cursor['v']
+    if last_value is None:
+        return None
+    python_type = sort.column.type.python_type
+    if issubclass(python_type, date):
+        try:
+            return date.fromisoformat(last_value)
+        except (ValueError, TypeError):
+            abort(400, {'message': 'invalid cursor.'})
+    if isinstance(last_value, bool) or \
+            not isinstance(last_value, python_type):
+        abort(400, {'message': 'invalid cursor.'})
+    if isinstance(last_value, int) and abs(last_value) > MAX_ID:
+        abort(400, {'message': 'invalid cursor.'})
+    return last_value
+
+
+def seek(id_column, sort, cursor):
+    '''
+    Rows after the cursor for the id sort, and for other sorts the
+    rows after it that have a sort value.
+    '''
+    if sort is None or sort.key == 'id':
+        if sort is not None and sort.descending:
+            return id_column < cursor['id']
+        return id_column > cursor['id']
+    last_value = cursor_value(sort, cursor)
+    if last_value is None:
+        return None
+    # a row value comparison is an index range condition on (column, id)
+    # and leaves out NULLs
+    key = tuple_(sort.column, id_column)
+    if sort.descending:
+        return key < tuple_(last_value, cursor['id'])
+    return key > tuple_(last_value, cursor['id'])
+
+
+def order(id_column, sort):
+    '''
+    ORDER BY sort NULLS LAST, id with id in the direction of the sort, so
+    an index on (column, id) is read forwards or backwards.
+    '''
+    if sort is None or sort.key == 'id':
+        if sort is not None and sort.descending:
+            return [id_column.desc()]
+        return [id_column]
+    if sort.descending:
+        return [sort.column.desc().nullslast(), id_column.desc()]
+    return [sort.column.asc().nullslast(), id_column]
+
+
+def seek_sorted(query, id_column, sort, cursor, offset, limit):
+    '''
+    limit rows of query after offset or past the cursor in the order of
+    order(). The rows with a sort value and the NULLs are two index range
+    scans, on (column, id) and on id, each stopping after offset + limit
+    rows, put together by UNION ALL.
+    '''
+    if sort.descending:
+        by_value = [sort.column.desc(), id_column.desc()]
+    else:
+        by_value = [sort.column, id_column]
+    nulls = query.filter(sort.column.is_(None))
+    if cursor is None:
+        values = query.filter(sort.column.isnot(None))
+    else:
+        condition = seek(id_column, sort, cursor)
+        if condition is None:
+            # the cursor is past every row with a sort value
+            after_id = seek(id_column, sort._replace(key='id'), cursor)
+            return nulls.filter(after_id).order_by(by_value[1]).limit(limit)
+        values = query.filter(condition)
+    values = values.order_by(*by_value).limit(offset + limit)
+    nulls = nulls.order_by(by_value[1]).limit(offset + limit)
+    return values.from_self().union_all(nulls.from_self()).order_by(
+        *order(id_column, sort)).offset(offset).limit(limit)
+
+
+def paginate_ranked(request, query):
+    '''
+    Returns (rows, next_page) for queries ordered by a rank,
+    where a keyset on id does not apply.
+    '''
+    page_size = get_page_size(request)
+    page, offset = get_page(request, page_size)
+    rows = query.offset(offset).limit(page_size + 1).all()
+    next_page = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_page = page + 1
+    return rows, next_page
+
+
+def cursor_row(row):
+    return row
+
+
+def paginate_query(request, query, id_column, cursor_key=cursor_row,
+                   sort=None):
+    '''
+    Returns (rows, next_cursor) for the requested page.
+    ?cursor= seeks past the last (sort value, id), otherwise ?page= is
+    translated to OFFSET. One extra row is fetched to know
+    whether a next page exists.
+    cursor_key maps a result row to the object holding id and sort key.
+    '''
+    page_size = get_page_size(request)
+    cursor = request.args.get('cursor', None)
+    offset = 0
+    if cursor:
+        cursor = decode_cursor(cursor)
+    else:
+        cursor = None
+        page, offset = get_page(request, page_size)
+
+    if sort is not None and sort.key != 'id':
+        query = seek_sorted(query, id_column, sort, cursor, offset,
+                            page_size + 1)
+    else:
+        if cursor is not None:
+            query = query.filter(seek(id_column, sort, cursor))
+        query = query.order_by(*order(id_column, sort)).offset(
+            offset).limit(page_size + 1)
+
+    rows = query.all()
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        last = cursor_key(rows[-1])
+        last_value = getattr(last, sort.key) if sort is not None else None
+        next_cursor = encode_cursor(last.id, sort, last_value)
+    return rows, next_cursor
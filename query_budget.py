@@ -0,0 +1,120 @@
+import logging
+import re
+import threading
+from collections import Counter
+from functools import wraps
+
+from flask import current_app, g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from config import QUERY_BUDGET_WARNINGS, QUERY_REPEAT_THRESHOLD
+
+'''
+Query budgets
+Routes declare how many SQL statements they may run with @query_budget,
+independent of the page size. count_queries() records the statements run
+on the current thread, tests wrap requests in it to hold every route to
+its budget. In debug mode (or with QUERY_BUDGET_WARNINGS) each request is
+counted and a warning is logged when it exceeds its budget or runs the
+same statement shape QUERY_REPEAT_THRESHOLD times, the sign of an N+1.
+'''
+
+logger = logging.getLogger('query_budget')
+
+_local = threading.local()
+
+# bind parameter lists of IN (...) and VALUES (...) collapse to one
+_PARAMETER_LIST = re.compile(
+    r'\((?:\s*(?:\?|%\(\w+\)s|%s|:\w+)\s*,)+\s*(?:\?|%\(\w+\)s|%s|:\w+)\s*\)')
+_WHITESPACE = re.compile(r'\s+')
+
+
+def statement_shape(statement):
+    '''The statement with whitespace and parameter lists normalized.'''
+    shape = _WHITESPACE.sub(' ', statement).strip()
+    return _PARAMETER_LIST.sub('(?)', shape)
+
+
+class QueryCounter:
+    def __init__(self):
+        self.statements = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def repeated(self, threshold=QUERY_REPEAT_THRESHOLD):
+        '''Statement shapes run at least threshold times.'''
+        shapes = Counter(statement_shape(statement)
+                         for statement in self.statements)
+        return {shape: times for shape, times in shapes.items()
+                if times >= threshold}
+
+    def __enter__(self):
+        _local.counters = getattr(_local, 'counters', ()) + (self,)
+        return self
+
+    def __exit__(self, *exc_info):
+        _local.counters = tuple(counter for counter in _local.counters
+                                if counter is not self)
+
+
+def count_queries():
+    '''
+    with count_queries() as queries:
+        client.get('/actors')
+    queries.count
+    '''
+    return QueryCounter()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_statement(conn, cursor, statement, parameters, context,
+                    executemany):
+    for counter in getattr(_local, 'counters', ()):
+        counter.statements.append(statement)
+
+
+def query_budget(statements):
+    '''Declares the most statements a view may run per request.'''
+    def query_budget_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            return f(*args, **kwargs)
+
+        wrapper.query_budget = statements
+        return wrapper
+
+    return query_budget_decorator
+
+
+def route_budgets(app):
+    '''{endpoint: budget} of the views that declare one.'''
+    return {endpoint: view.query_budget
+            for endpoint, view in app.view_functions.items()
+            if hasattr(view, 'query_budget')}
+
+
+def init_query_budgets(app):
+    @app.before_request
+    def start_query_count():
+        if current_app.debug or current_app.config.get(
+                'QUERY_BUDGET_WARNINGS', QUERY_BUDGET_WARNINGS):
+            g.query_counter = count_queries().__enter__()
+
+    @app.teardown_request
+    def check_query_count(exc=None):
+        counter = g.pop('query_counter', None)
+        if counter is None:
+            return
+        counter.__exit__()
+        view = current_app.view_functions.get(request.endpoint)
+        budget = getattr(view, 'query_budget', None)
+        if budget is not None and counter.count > budget:
+            logger.warning('%s %s ran %d statements, budget is %d',
+                           request.method, request.path, counter.count,
+                           budget)
+        for shape, times in counter.repeated().items():
+            logger.warning('%s %s ran the same statement %d times: %s',
+                           request.method, request.path, times, shape)
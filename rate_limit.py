@@ -0,0 +1,142 @@
+import math
+import threading
+import time
+
+from flask import current_app, g, request
+
+from config import (IN_FLIGHT_RETRY_AFTER, MAX_IN_FLIGHT,
+                    RATE_LIMIT_ENABLED, RATE_LIMIT_KEYS, RATE_LIMITS)
+from lru import LRUCache
+
+'''
+Admission control
+Every authenticated request takes a token from the bucket of its JWT sub
+and permission. Buckets refill at the permission's rate up to its burst
+and an empty bucket answers 429 with Retry-After. Quotas are looked up by
+permission ('create:actors'), then by its verb ('create'), then 'default'.
+The in-flight cap counts the requests this process is serving and answers
+503 once MAX_IN_FLIGHT are running, before requests queue on the
+connection pool until DB_POOL_TIMEOUT.
+'''
+
+
+class RateLimitError(Exception):
+    def __init__(self, message, status_code, retry_after):
+        self.message = message
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+def parse_quotas(text):
+    '''"get=50/100,delete=5/10" -> {'get': (50.0, 100.0), ...}'''
+    quotas = {}
+    for item in text.split(','):
+        if not item.strip():
+            continue
+        permission, quota = item.split('=')
+        rate, burst = quota.split('/')
+        quotas[permission.strip()] = (float(rate), float(burst))
+    return quotas
+
+
+def find_quota(permission, quotas):
+    '''(rate, burst) of the permission, None when it is unlimited.'''
+    for key in (permission, permission.split(':')[0], 'default'):
+        if key in quotas:
+            return quotas[key]
+    return None
+
+
+class MemoryRateLimitBackend:
+    '''
+    Per-process buckets, each worker applies the full quota on its own.
+    Idle buckets are evicted least recently used first.
+    '''
+
+    def __init__(self, max_keys=RATE_LIMIT_KEYS):
+        self._buckets = LRUCache(max_keys)
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        '''Seconds until a token is available, 0 when one was taken.'''
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens >= 1:
+                self._buckets.set(key, (tokens - 1, now))
+                return 0
+            self._buckets.set(key, (tokens, now))
+        return (1 - tokens) / rate if rate > 0 else math.inf
+
+
+DEFAULT_QUOTAS = parse_quotas(RATE_LIMITS)
+
+_backend = MemoryRateLimitBackend()
+
+
+def set_backend(backend):
+    '''Replaces the buckets by any object with take().'''
+    global _backend
+    _backend = backend
+
+
+def check_rate_limit(permission, payload):
+    '''Raises RateLimitError when the sub has used up its quota.'''
+    config = current_app.config
+    if not config.get('RATE_LIMIT_ENABLED', RATE_LIMIT_ENABLED):
+        return
+    quotas = config.get('RATE_LIMITS', DEFAULT_QUOTAS)
+    if isinstance(quotas, str):
+        quotas = parse_quotas(quotas)
+    quota = find_quota(permission, quotas)
+    if quota is None:
+        return
+    rate, burst = quota
+    wait = _backend.take((payload.get('sub'), permission), rate, burst)
+    if wait:
+        raise RateLimitError('rate limit exceeded', 429,
+                             max(1, math.ceil(min(wait, 3600))))
+
+
+class InFlight:
+    '''Requests being served by this process.'''
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def enter(self, limit):
+        with self._lock:
+            if limit and self.count >= limit:
+                return False
+            self.count += 1
+            return True
+
+    def exit(self):
+        with self._lock:
+            self.count -= 1
+
+
+in_flight = InFlight()
+
+# cheap endpoints that must answer while the process is saturated
+UNCAPPED_ENDPOINTS = {'get_health', 'get_metrics'}
+
+
+def init_admission_control(app):
+    @app.before_request
+    def enter_in_flight():
+        if request.endpoint in UNCAPPED_ENDPOINTS:
+            return
+        limit = current_app.config.get('MAX_IN_FLIGHT', MAX_IN_FLIGHT)
+        if not in_flight.enter(limit):
+            raise RateLimitError(
+                'server busy', 503, current_app.config.get(
+                    'IN_FLIGHT_RETRY_AFTER', IN_FLIGHT_RETRY_AFTER))
+        g.in_flight = True
+
+    @app.teardown_request
+    def exit_in_flight(exc=None):
+        if g.pop('in_flight', False):
+            in_flight.exit()
@@ -0,0 +1,59 @@
+import time
+from collections import namedtuple
+
+from config import RECORD_CACHE_SIZE, RECORD_CACHE_TTL
+from lru import LRUCache
+
+'''
+Record cache
+Keeps the column values of recently read actors and movies keyed by
+(table, id) for the single-record and ?ids= endpoints. Entries are
+dropped by the update()/delete() model helpers of this process and
+expire after RECORD_CACHE_TTL seconds, which bounds how stale a record
+written through another worker can be.
+'''
+
+CachedRecord = namedtuple('CachedRecord', ['values', 'expires'])
+
+
+class RecordCache:
+    def __init__(self, max_size=RECORD_CACHE_SIZE, ttl=RECORD_CACHE_TTL):
+        self._entries = LRUCache(max_size)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, table, ids):
+        '''{id: values} of the cached ids, missing ones are left out.'''
+        now = time.monotonic()
+        found = {}
+        for record_id in ids:
+            entry = self._entries.get((table, record_id))
+            if entry is not None and entry.expires <= now:
+                self._entries.delete((table, record_id))
+                entry = None
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                found[record_id] = entry.values
+        return found
+
+    def set_many(self, table, records):
+        expires = time.monotonic() + self.ttl
+        for record_id, values in records.items():
+            self._entries.set((table, record_id),
+                              CachedRecord(values, expires))
+
+    def invalidate(self, table, ids):
+        for record_id in ids:
+            self._entries.delete((table, record_id))
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+record_cache = RecordCache()
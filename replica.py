@@ -0,0 +1,183 @@
+import math
+import threading
+import time
+
+from flask import current_app, g, has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import event, orm, text
+
+from config import (READ_YOUR_WRITES_SECONDS, REPLICA_LAG_CHECK_INTERVAL,
+                    REPLICA_MAX_LAG_SECONDS)
+
+'''
+Read replica routing
+With REPLICA_DATABASE_URL set the replica is the 'replica' bind of db.
+Requests authorized with a get: permission read from it, everything else
+and every flush stays on the primary. A write answers with a cookie that
+keeps the client's reads on the primary for READ_YOUR_WRITES_SECONDS,
+whichever worker serves them, and all reads go to the primary while the
+replica lags more than REPLICA_MAX_LAG_SECONDS or cannot be reached.
+Rows read from the replica shortly after a commit of this process are
+not put in the response and record caches, which that commit has just
+invalidated.
+'''
+
+REPLICA_BIND = 'replica'
+
+# deadline of the client's reads from the primary, seconds since the epoch
+PIN_COOKIE = 'read_primary_until'
+
+# seconds the Postgres standby is behind, 0 when it has replayed all it got
+LAG_QUERY = '''
+SELECT CASE
+    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+END
+'''
+
+_last_commit = 0.0
+
+
+class RoutingSession(SignallingSession):
+    '''Session reading from the replica for requests routed to it.'''
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and has_request_context() and \
+                g.get('read_replica') is not None:
+            return get_state(self.app).db.get_engine(
+                self.app, bind=REPLICA_BIND)
+        return super().get_bind(mapper, clause)
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def note_commit(session):
+    global _last_commit
+    _last_commit = time.monotonic()
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def measure_lag(engine):
+    '''Seconds the replica is behind, None when it cannot be reached.'''
+    if engine.dialect.name != 'postgresql':
+        return 0.0
+    try:
+        with engine.connect() as connection:
+            lag = connection.execute(text(LAG_QUERY)).scalar()
+    except Exception:
+        return None
+    # NULL when the server is not a standby
+    return float(lag or 0.0)
+
+
+class ReplicaRouter:
+    def __init__(self, max_lag=REPLICA_MAX_LAG_SECONDS,
+                 check_interval=REPLICA_LAG_CHECK_INTERVAL):
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.lag = None
+        self.checked_at = None
+        self.reads = 0
+        self.fallbacks = 0
+        self._lock = threading.Lock()
+
+    def current_lag(self, engine):
+        '''The lag, measured at most once per check_interval.'''
+        now = time.monotonic()
+        if self.checked_at is None or \
+                now - self.checked_at >= self.check_interval:
+            with self._lock:
+                if self.checked_at is None or \
+                        now - self.checked_at >= self.check_interval:
+                    self.lag = measure_lag(engine)
+                    self.checked_at = now
+        return self.lag
+
+    def usable(self, engine):
+        lag = self.current_lag(engine)
+        usable = lag is not None and lag <= self.max_lag
+        if usable:
+            self.reads += 1
+        else:
+            self.fallbacks += 1
+        return usable
+
+    def status(self):
+        # as of the last check, /health/db runs no statement
+        return {
+            'lag_seconds': self.lag,
+            'max_lag_seconds': self.max_lag,
+            'reads': self.reads,
+            'fallbacks': self.fallbacks
+        }
+
+
+def init_replica(app, replica_uri):
+    '''Adds the replica bind, called by db_init before db.init_app.'''
+    binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+    binds[REPLICA_BIND] = replica_uri
+    app.config['SQLALCHEMY_BINDS'] = binds
+    app.extensions['replica'] = ReplicaRouter(
+        app.config.get('REPLICA_MAX_LAG_SECONDS', REPLICA_MAX_LAG_SECONDS),
+        app.config.get('REPLICA_LAG_CHECK_INTERVAL',
+                       REPLICA_LAG_CHECK_INTERVAL))
+
+    @app.after_request
+    def pin_after_write(response):
+        # the window starts once the write is over, whichever worker
+        # serves the next read gets the cookie back
+        if g.pop('pin_primary', False):
+            seconds = read_your_writes_seconds()
+            response.set_cookie(
+                PIN_COOKIE, '{:.3f}'.format(time.time() + seconds),
+                max_age=math.ceil(seconds), httponly=True, samesite='Lax')
+        return response
+
+
+def read_your_writes_seconds():
+    return current_app.config.get('READ_YOUR_WRITES_SECONDS',
+                                  READ_YOUR_WRITES_SECONDS)
+
+
+def pinned():
+    '''
+    True while the pin cookie of the request is running, a deadline
+    further away than the window is ignored.
+    '''
+    try:
+        until = float(request.cookies.get(PIN_COOKIE, 0))
+    except ValueError:
+        return False
+    now = time.time()
+    return now < until <= now + read_your_writes_seconds()
+
+
+def route_request(permission):
+    '''Routes reads of the request to the replica when it may serve them.'''
+    router = current_app.extensions.get('replica')
+    if router is None:
+        return
+    if not permission.startswith('get:'):
+        g.pin_primary = True
+        return
+    if pinned():
+        return
+    engine = get_state(current_app).db.get_engine(
+        current_app, bind=REPLICA_BIND)
+    if router.usable(engine):
+        g.read_replica = router
+
+
+def replica_may_be_stale():
+    '''
+    True when the request reads from the replica and this process
+    committed within the lag the replica is allowed to have.
+    '''
+    router = g.get('read_replica') if has_request_context() else None
+    if router is None:
+        return False
+    window = router.max_lag + router.check_interval
+    return time.monotonic() - _last_commit < window
@@ -0,0 +1,128 @@
+import json
+import logging
+import random
+import time
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+'''
+Per-request timing
+A sampled request counts its SQL statements and adds up the time spent
+in SQL, token verification, JWKS fetches and JSON serialization. The
+totals are returned in a Server-Timing header and logged as one JSON line
+on the request_timing logger. Unsampled requests only pay for a lookup
+on flask.g in the engine and encoder hooks.
+'''
+
+logger = logging.getLogger('request_timing')
+
+# Server-Timing metrics besides sql and total, in header order
+TIMED_PHASES = ('auth', 'jwks', 'serialize')
+
+
+class RequestTiming:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.sql_count = 0
+        self.seconds = {}
+
+    def add(self, name, seconds):
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+
+    def milliseconds(self, name):
+        return round(self.seconds.get(name, 0.0) * 1000.0, 3)
+
+    def server_timing(self, total):
+        metrics = ['sql;dur={};desc="{} statements"'.format(
+            self.milliseconds('sql'), self.sql_count)]
+        metrics.extend('{};dur={}'.format(name, self.milliseconds(name))
+                       for name in TIMED_PHASES if name in self.seconds)
+        metrics.append('total;dur={}'.format(round(total * 1000.0, 3)))
+        return ', '.join(metrics)
+
+    def log_record(self, response, total):
+        record = {
+            'method': request.method,
+            'path': request.path,
+            'endpoint': request.endpoint,
+            'status': response.status_code,
+            'total_ms': round(total * 1000.0, 3),
+            'sql_count': self.sql_count,
+            'sql_ms': self.milliseconds('sql')
+        }
+        for name in TIMED_PHASES:
+            record[name + '_ms'] = self.milliseconds(name)
+        return record
+
+
+def current_timing():
+    '''The RequestTiming of a sampled request, otherwise None.'''
+    if not has_request_context():
+        return None
+    return g.get('request_timing')
+
+
+def record_timing(name, seconds):
+    timing = current_timing()
+    if timing is not None:
+        timing.add(name, seconds)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement_timing(conn, cursor, statement, parameters, context,
+                           executemany):
+    if current_timing() is not None:
+        conn.info['statement_started'] = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def stop_statement_timing(conn, cursor, statement, parameters, context,
+                          executemany):
+    timing = current_timing()
+    started = conn.info.pop('statement_started', None)
+    if timing is not None and started is not None:
+        timing.sql_count += 1
+        timing.add('sql', time.perf_counter() - started)
+
+
+def timed_json_encoder(base):
+    '''Subclass of the app's JSON encoder that records serialization.'''
+    class TimedJSONEncoder(base):
+        def encode(self, o):
+            timing = current_timing()
+            if timing is None:
+                return super().encode(o)
+            started = time.perf_counter()
+            try:
+                return super().encode(o)
+            finally:
+                timing.add('serialize', time.perf_counter() - started)
+
+    return TimedJSONEncoder
+
+
+def init_request_timing(app, sample_rate):
+    '''Times the given fraction of requests, 0 turns timing off.'''
+    app.json_encoder = timed_json_encoder(app.json_encoder)
+    if logger.level == logging.NOTSET:
+        logger.setLevel(logging.INFO)
+    if not logger.handlers and not logging.getLogger().handlers:
+        logger.addHandler(logging.StreamHandler())
+
+    @app.before_request
+    def start_request_timing():
+        sampled = sample_rate > 0 and random.random() < sample_rate
+        g.request_timing = RequestTiming() if sampled else None
+
+    @app.after_request
+    def finish_request_timing(response):
+        timing = current_timing()
+        if timing is None:
+            return response
+        total = time.perf_counter() - timing.started
+        response.headers['Server-Timing'] = timing.server_timing(total)
+        logger.info(json.dumps(timing.log_record(response, total),
+                               sort_keys=True))
+        return response
@@ -0,0 +1,118 @@
+import hashlib
+import threading
+import time
+from collections import namedtuple
+from functools import wraps
+
+from flask import current_app, make_response, request
+
+from config import (RESPONSE_CACHE_ENABLED, RESPONSE_CACHE_SIZE,
+                    RESPONSE_CACHE_TTL)
+from lru import LRUCache
+from replica import replica_may_be_stale
+
+'''
+HTTP response cache
+GET responses are cached by route, query args, permission scope and the
+version of every table the route reads. The model write helpers bump the
+table versions, so a write changes the key and stale entries are never
+hit again. Responses carry a strong ETag and If-None-Match gets a 304.
+'''
+
+CachedResponse = namedtuple(
+    'CachedResponse', ['body', 'etag', 'mimetype', 'expires'])
+
+
+class MemoryCacheBackend:
+    '''
+    Per-process LRU. Versions are local to the worker, entries expire after
+    RESPONSE_CACHE_TTL to bound staleness from writes in other workers.
+    '''
+
+    def __init__(self, max_entries=RESPONSE_CACHE_SIZE):
+        self._entries = LRUCache(max_entries)
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self._entries.get(key)
+
+    def set(self, key, value):
+        self._entries.set(key, value)
+
+    def get_version(self, table):
+        return self._versions.get(table, 0)
+
+    def bump_version(self, table):
+        with self._lock:
+            self._versions[table] = self._versions.get(table, 0) + 1
+
+
+_backend = MemoryCacheBackend()
+
+
+def set_backend(backend):
+    '''
+    Replaces the per-process cache by a store shared by all gunicorn
+    workers (e.g. redis), any object with get(key), set(key, value),
+    get_version(table) and bump_version(table).
+    '''
+    global _backend
+    _backend = backend
+
+
+def bump_table_version(*tables):
+    for table in tables:
+        _backend.bump_version(table)
+
+
+def cache_key(payload, tables):
+    scope = ','.join(sorted(payload.get('permissions', [])))
+    args = '&'.join('{}={}'.format(key, value) for key, value in
+                    sorted(request.args.items(multi=True)))
+    versions = ','.join('{}:{}'.format(table, _backend.get_version(table))
+                        for table in tables)
+    raw = '|'.join((request.path, args, scope, versions))
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def conditional_response(cached):
+    if request.if_none_match.contains(cached.etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = current_app.response_class(
+            cached.body, mimetype=cached.mimetype)
+    response.set_etag(cached.etag)
+    response.vary.add('Authorization')
+    return response
+
+
+def cached_response(*tables):
+    '''
+    Decorates a view wrapped by requires_auth.
+    tables are the tables whose versions invalidate the response.
+    '''
+    def cached_response_decorator(f):
+        @wraps(f)
+        def wrapper(payload, *args, **kwargs):
+            config = current_app.config
+            if not config.get('RESPONSE_CACHE_ENABLED',
+                              RESPONSE_CACHE_ENABLED):
+                return f(payload, *args, **kwargs)
+            key = cache_key(payload, tables)
+            cached = _backend.get(key)
+            if cached is None or cached.expires <= time.time():
+                response = make_response(f(payload, *args, **kwargs))
+                if response.status_code != 200 or replica_may_be_stale():
+                    return response
+                body = response.get_data()
+                cached = CachedResponse(
+                    body, hashlib.sha1(body).hexdigest(), response.mimetype,
+                    time.time() + config.get('RESPONSE_CACHE_TTL',
+                                             RESPONSE_CACHE_TTL))
+                _backend.set(key, cached)
+            return conditional_response(cached)
+
+        return wrapper
+
+    return cached_response_decorator
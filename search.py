@@ -0,0 +1,36 @@
+from sqlalchemy import case, func, or_
+
+'''
+Name/title search
+Prefix matches on lower(column) use the text_pattern_ops index, fuzzy
+matches use the pg_trgm % operator and the GIN trigram index. Prefix
+hits rank first, then trigram similarity. Other databases fall back to
+LIKE with the same prefix-first ranking.
+'''
+
+SEARCH_MODES = ('prefix', 'fuzzy')
+
+
+def escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def search_query(session, model, column, q, mode):
+    lowered = func.lower(column)
+    q = q.lower()
+    prefix = lowered.like(escape_like(q) + '%', escape='\\')
+    prefix_rank = case([(prefix, 1)], else_=0).desc()
+    query = session.query(model)
+
+    if mode == 'prefix':
+        return query.filter(prefix).order_by(
+            func.length(column), model.id)
+
+    if session.get_bind().dialect.name == 'postgresql':
+        # pg_trgm similarity operator, doubled for psycopg2's pyformat
+        similar = lowered.op('%%')(q)
+        return query.filter(or_(prefix, similar)).order_by(
+            prefix_rank, func.similarity(lowered, q).desc(), model.id)
+
+    contains = lowered.like('%' + escape_like(q) + '%', escape='\\')
+    return query.filter(contains).order_by(prefix_rank, model.id)
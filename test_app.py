@@ -1,46 +1,64 @@
+import base64
 import os
+import tempfile
+import time
 import unittest
 from datetime import date
 
-from flask_sqlalchemy import SQLAlchemy
 import json
+import app as app_module
 from app import create_app
-from config import tokens
-from models import db_init, db_reboot
+from config import BULK_MAX_RECORDS
+from benchmark import (AppClient, compare, mint_tokens, run_benchmark,
+                       scenario_headers, scenarios, seed, uncovered_routes)
+from importer import (NO_STATEMENT_TIMEOUT, CopyStream, import_file,
+                      rebuild_budget_stats, upsert_statements)
+from jwks import JWKSStore
+from local_auth import mint_token
+from token_cache import TokenCache
+from models import db, db_reboot, Actor
+from query_budget import (count_queries, query_budget, route_budgets,
+                          statement_shape)
+from metrics import metrics
+from rate_limit import in_flight
 
+# offline tokens signed by the local RSA key, see local_auth.py
 assistant_header = {
-    'Authorization': tokens['casting_assistant']
+    'Authorization': 'Bearer ' + mint_token('casting_assistant')
 }
 
 director_header = {
-    'Authorization': tokens['casting_director']
+    'Authorization': 'Bearer ' + mint_token('casting_director')
 }
 
 producer_header = {
-    'Authorization': tokens['executive_producer']
+    'Authorization': 'Bearer ' + mint_token('executive_producer')
 }
 
 
 class CastingAgencyTestCase(unittest.TestCase):
     def setUp(self):
-        self.app = create_app()
+        # TEST_DB_PROFILE=postgres-local runs the suite against Postgres
+        self.app = create_app({
+            'DB_PROFILE': os.environ.get('TEST_DB_PROFILE', 'sqlite-memory'),
+            'AUTH_MODE': 'offline'
+        })
         self.client = self.app.test_client
-        self.database_name = "casting_agency"
-        self.database_path = "postgres://{}/{}".format(
-            'localhost:5432', self.database_name)
-        db_init(self.app)
-        db_reboot()
         # binds the app to the current context
         with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
+            db_reboot()
 
     def tearDown(self):
         """Executed after reach test"""
         pass
 
+    def test_db_health(self):
+        """Pool statistics are exposed"""
+        result = self.client().get('/health/db')
+        data = json.loads(result.data)
+        self.assertEqual(result.status_code, 200)
+        self.assertIn('checkouts', data['pool'])
+
     # ---------------------
     # POST /actors
     # ---------------------
@@ -70,6 +88,55 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(result.status_code, 401)
         self.assertFalse(data['success'])
 
+    # ---------------------
+    # POST /actors/bulk
+    # ---------------------
+
+    def test_bulk_create_actors(self):
+        """Director creates actors in one call"""
+        actors = [{'name': 'Andy', 'age': 29}, {'name': 'Bea', 'age': 31}]
+        result = self.client().post(
+            '/actors/bulk', json={'actors': actors}, headers=director_header
+        )
+        data = json.loads(result.data)
+        self.assertEqual(result.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual(len(data['created']), 2)
+        self.assertTrue(data['created'][0] < data['created'][1])
+
+    def test_bulk_create_atomic_error(self):
+        """Atomic bulk create rejects the whole batch"""
+        actors = [{'name': 'Andy', 'age': 29}, {'name': 'Bea'}]
+        result = self.client().post(
+            '/actors/bulk', json=actors, headers=director_header
+        )
+        data = json.loads(result.data)
+        self.assertEqual(result.status_code, 422)
+        self.assertFalse(data['success'])
+        self.assertEqual(data['errors'][0]['index'], 1)
+
+    def test_bulk_create_partial(self):
+        """Partial bulk create keeps the valid records"""
+        actors = [{'name': 'Andy', 'age': 29}, {'name': 'Bea'}]
+        result = self.client().post(
+            '/actors/bulk?mode=partial', json=actors, headers=director_header
+        )
+        data = json.loads(result.data)
+        self.assertEqual(result.status_code, 200)
+        self.assertIsNotNone(data['created'][0])
+        self.assertIsNone(data['created'][1])
+        self.assertEqual(len(data['errors']), 1)
+
+        actors = [{'name': 'Old', 'age': 10 ** 20}, {'name': 'Cy', 'age': 40}]
+        result = self.client().post(
+            '/actors/bulk?mode=partial', json=actors, headers=director_header
+        )
+        data = json.loads(result.data)
+        self.assertEqual(result.status_code, 200)
+        self.assertIsNone(data['created'][0])
+        self.assertIsNotNone(data['created'][1])
+        self.assertEqual(data['errors'][0]['index'], 0)
+
     # -------------
     # GET /actors
     # -------------
@@ -82,6 +149,138 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertTrue(data['success'])
         self.assertTrue(len(data['actors']) > 0)
 
+    def test_get_actors_cursor(self):
+        """GET actors with page_size and keyset cursor."""
+        result = self.client().get(
+            '/actors?page_size=2', headers=assistant_header)
+        data = json.loads(result.data)
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(len(data['actors']), 2)
+        self.assertTrue(data['next_cursor'])
+
+        result = self.client().get(
+            '/actors?page_size=2&cursor={}'.format(data['next_cursor']),
+            headers=assistant_header)
+        next_page = json.loads(result.data)
+        self.assertEqual(result.status_code, 200)
+        self.assertTrue(
+            next_page['actors'][0]['id'] > data['actors'][-1]['id'])
+        self.assertIsNone(next_page['next_cursor'])
+
+    def test_get_actors_include_movies(self):
+        """GET actors with their movies expanded"""
+        result = self.client().get(
+            '/actors?include=movies', headers=assistant_header)
+        data = json.loads(result.data)
+        self.assertEqual(result.status_code, 200)
+        self.assertIn('movies', data['actors'][0])
+
+        result = self.client().get('/actors', headers=assistant_header)
+        data = json.loads(result.data)
+        self.assertNotIn('movies', data['actors'][0])
+
+    def test_get_actors_etag(self):
+        """Cached GET answers If-None-Match with 304 until a write"""
+        result = self.client().get('/actors', headers=assistant_header)
+        etag = result.headers['ETag']
+        self.assertEqual(result.status_code, 200)
+
+        headers = dict(assistant_header, **{'If-None-Match': etag})
+        result = self.client().get('/actors', headers=headers)
+        self.assertEqual(result.status_code, 304)
+
+        self.client().patch(
+            '/actors/1', json={'age': 45}, headers=director_header)
+        result = self.client().get('/actors', headers=headers)
+        self.assertEqual(result.status_code, 200)
+        self.assertNotEqual(result.headers['ETag'], etag)
+
+        uncached = create_app({'DB_PROFILE': 'sqlite-memory',
+                               'AUTH_MODE': 'offline',
+                               'RESPONSE_CACHE_ENABLED': False})
+        with uncached.app_context():
+            db_reboot()
+        result = uncached.test_client().get(
+            '/actors', headers=assistant_header)
+        self.assertEqual(result.status_code, 200)
+        self.assertNotIn('ETag', result.headers)
+
+    def test_get_actors_filter_and_sort(self):
+        """GET actors filtered by age and sorted by age descending"""
+        result = self.client().get(
+            '/actors?age_min=50&sort=-age', headers=assistant_header)
+        data = json.loads(result.data)
+        self.assertEqual(result.status_code, 200)
+        ages = [actor['age'] for actor in data['actors']]
+        self.assertEqual(ages, sorted(ages, reverse=True))
+        self.assertTrue(min(ages) >= 50)
+
+    def test_400_unknown_sort(self):
+        """GET actors sorted by a column outside the whitelist"""
+        result = self.client().get(
+            '/actors?sort=gender', headers=assistant_header)
+        self.assertEqual(result.status_code, 400)
+
+    def test_400_invalid_cursor(self):
+        """GET actors with a malformed cursor"""
+        result = self.client().get(
+            '/actors?cursor=not-a-cursor', headers=assistant_header)
+        data = json.loads(result.data)
+        self.assertEqual(result.status_code, 400)
+        self.assertFalse(data['success'])
+
+        for cursor in ('eyJpZCI6MWU0MDB9', 'eyJpZCI6MTAwMDAwMDAwMDAwMH0'):
+            result = self.client().get(
+                '/actors?cursor=' + cursor, headers=assistant_header)
+            self.assertEqual(result.status_code, 400, cursor)
+        result = self.client().get(
+            '/actors?page=' + '9' * 30, headers=assistant_header)
+        self.assertEqual(result.status_code, 400)
+
+    def test_400_cursor_value(self):
+        """GET with a cursor whose sort value does not fit the column"""
+        for path, cursor in [
+                ('/actors?sort=-age', {'id': 1, 's': 'age'}),
+                ('/actors?sort=-age', {'id': 1, 's': 'age', 'v': 'old'}),
+                ('/actors?sort=-age', {'id': 1, 's': 'age', 'v': 10 ** 20}),
+                ('/movies?sort=release_date',
+                 {'id': 1, 's': 'release_date', 'v': 5}),
+                ('/movies?sort=release_date',
+                 {'id': 1, 's': 'release_date', 'v': 'bad'})]:
+            result = self.client().get(
+                '{}&cursor={}'.format(path, base64.urlsafe_b64encode(
+                    json.dumps(cursor).encode()).decode().rstrip('=')),
+                headers=assistant_header)
+            self.assertEqual(result.status_code, 400, cursor)
+
+    def test_get_actors_sorted_pages_with_nulls(self):
+        """Cursor pages sorted by age descending end with NULL ages"""
+        with self.app.app_context():
+            db.session.add_all([Actor('Unknown A', 'female', None),
+                                Actor('Unknown B', 'male', None)])
+            db.session.commit()
+            keys = [(actor.age, actor.id) for actor in Actor.query]
+        values = sorted(key for key in keys if key[0] is not None)
+        nulls = sorted(key for key in keys if key[0] is None)
+
+        seen, path = [], '/actors?sort=-age&page_size=1'
+        while path:
+            data = json.loads(self.client().get(
+                path, headers=assistant_header).data)
+            seen.extend((actor['age'], actor['id'])
+                        for actor in data['actors'])
+            path = data['next_cursor'] and \
+                '/actors?sort=-age&page_size=1&cursor={}'.format(
+                    data['next_cursor'])
+        self.assertEqual(seen, values[::-1] + nulls[::-1])
+
+        data = json.loads(self.client().get(
+            '/actors?sort=age&page_size=2&page=2',
+            headers=assistant_header).data)
+        self.assertEqual([(actor['age'], actor['id'])
+                          for actor in data['actors']],
+                         (values + nulls)[2:4])
+
     def test_404_errors(self):
         """actors not existing."""
         result = self.client().get(
@@ -91,6 +290,24 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(result.status_code, 404)
         self.assertFalse(data['success'])
 
+    # ----------------------
+    # GET /actors/search
+    # ----------------------
+
+    def test_search_actors(self):
+        """Search actors by name prefix"""
+        result = self.client().get(
+            '/actors/search?q=an&mode=prefix', headers=assistant_header)
+        data = json.loads(result.data)
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(data['actors'][0]['name'], 'Anant')
+
+    def test_400_search_without_q(self):
+        """Search without a query"""
+        result = self.client().get(
+            '/actors/search', headers=assistant_header)
+        self.assertEqual(result.status_code, 400)
+
     # ----------------------
     # DELETE /actors
     # ----------------------
@@ -152,6 +369,135 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertTrue(data['success'])
         self.assertTrue(len(data['actor']) > 0)
 
+    def test_bulk_update_actors(self):
+        """PATCH /actors applies every change in one UPDATE"""
+        with count_queries() as queries:
+            result = self.client().patch('/actors', json={'actors': [
+                {'id': 1, 'changes': {'age': 40}, 'version': 1},
+                {'id': 2, 'changes': {'name': 'Shah Rukh', 'age': 56}}
+            ]}, headers=director_header)
+        data = json.loads(result.data)
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(data['updated'], [{'id': 1, 'version': 2},
+                                           {'id': 2, 'version': 2}])
+        self.assertEqual(queries.count, 2)
+        result = self.client().get('/actors?ids=1,2',
+                                   headers=assistant_header)
+        actors = json.loads(result.data)['actors']
+        self.assertEqual([actor['age'] for actor in actors], [40, 56])
+        self.assertEqual(actors[1]['name'], 'Shah Rukh')
+
+    def test_bulk_update_version_conflict(self):
+        """A stale version rejects the whole batch unless mode=partial"""
+        items = [{'id': 1, 'changes': {'age': 41}, 'version': 7},
+                 {'id': 2, 'changes': {'age': 57}},
+                 {'id': 999, 'changes': {'age': 1}}]
+        result = self.client().patch('/actors', json=items,
+                                     headers=director_header)
+        data = json.loads(result.data)
+        self.assertEqual(result.status_code, 409)
+        self.assertEqual((data['conflicts'], data['missing']), ([1], [999]))
+        result = self.client().get('/actors/2', headers=assistant_header)
+        self.assertEqual(json.loads(result.data)['actor']['version'], 1)
+
+        result = self.client().patch('/actors?mode=partial', json=items,
+                                     headers=director_header)
+        data = json.loads(result.data)
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(data['updated'], [{'id': 2, 'version': 2}])
+
+        result = self.client().patch('/movies', json=[
+            {'id': 1, 'changes': {'budget': 1}}], headers=producer_header)
+        self.assertEqual(result.status_code, 422)
+
+        for item in ({'id': 10 ** 20, 'changes': {'age': 1}},
+                     {'id': 1, 'changes': {'age': 10 ** 20}},
+                     {'id': 1, 'changes': {'age': 1}, 'version': 10 ** 20}):
+            result = self.client().patch('/actors', json=[item],
+                                         headers=director_header)
+            self.assertEqual(result.status_code, 422, item)
+        result = self.client().delete('/actors?ids=' + '9' * 20,
+                                      headers=director_header)
+        self.assertEqual(result.status_code, 400)
+
+    def test_bulk_update_stale_version(self):
+        """A version already bumped once is a conflict, not an update"""
+        self.client().patch('/actors/1', json={'age': 45},
+                            headers=director_header)
+        items = [{'id': 1, 'changes': {'age': 99}, 'version': 1}]
+        result = self.client().patch('/actors', json=items,
+                                     headers=director_header)
+        data = json.loads(result.data)
+        self.assertEqual(result.status_code, 409)
+        self.assertEqual(data['conflicts'], [1])
+
+        result = self.client().patch('/actors?mode=partial', json=items,
+                                     headers=director_header)
+        data = json.loads(result.data)
+        self.assertEqual((data['updated'], data['conflicts']), ([], [1]))
+        result = self.client().get('/actors/1', headers=assistant_header)
+        actor = json.loads(result.data)['actor']
+        self.assertEqual((actor['age'], actor['version']), (45, 2))
+
+    def test_bulk_delete_movies(self):
+        """DELETE /movies?ids= removes the rows and their budgets"""
+        result = self.client().delete('/movies?ids=1,2,999',
+                                      headers=producer_header)
+        data = json.loads(result.data)
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(sorted(data['deleted']), [1, 2])
+        self.assertEqual(data['missing'], [999])
+        result = self.client().get('/stats/budgets?group=month',
+                                   headers=assistant_header)
+        months = json.loads(result.data)['budgets']
+        self.assertEqual(sum(month['movie_count'] for month in months), 1)
+
+        result = self.client().delete('/movies?ids=3',
+                                      headers=director_header)
+        self.assertEqual(result.status_code, 401)
+
+    def test_get_one_actor(self):
+        """GET a single actor, cached until it is updated"""
+        result = self.client().get('/actors/1', headers=assistant_header)
+        data = json.loads(result.data)
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(data['actor']['name'], 'Anant')
+
+        self.client().patch('/actors/1', json={'age': 31},
+                            headers=director_header)
+        with count_queries() as queries:
+            result = self.client().get('/actors/1?fields=age',
+                                       headers=assistant_header)
+        self.assertEqual(json.loads(result.data)['actor'], {'age': 31})
+        self.assertEqual(queries.count, 1)
+        with count_queries() as queries:
+            self.client().get('/actors/1', headers=assistant_header)
+        self.assertEqual(queries.count, 0)
+
+        result = self.client().get('/actors/999', headers=assistant_header)
+        self.assertEqual(result.status_code, 404)
+
+    def test_get_actors_by_ids(self):
+        """?ids= returns the records in request order"""
+        with count_queries() as queries:
+            result = self.client().get('/actors?ids=2,999,1',
+                                       headers=assistant_header)
+        data = json.loads(result.data)
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual([actor['id'] for actor in data['actors']], [2, 1])
+        self.assertEqual(data['missing'], [999])
+        self.assertEqual(queries.count, 1)
+
+        result = self.client().get('/movies?ids=1,x',
+                                   headers=assistant_header)
+        self.assertEqual(result.status_code, 400)
+
+        huge = '9' * 20
+        for path in ('/actors?ids=1,' + huge, '/actors/' + huge,
+                     '/movies/{}/actors'.format(huge)):
+            result = self.client().get(path, headers=assistant_header)
+            self.assertEqual(result.status_code, 400, path)
+
     # -----------------------
     # POST /movies
     # -----------------------
@@ -197,6 +543,64 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertTrue(data['success'])
         self.assertTrue(len(data['movies']) > 0)
 
+    def test_sparse_fieldsets(self):
+        """?fields= prunes the payload and the SELECT"""
+        with count_queries() as queries:
+            result = self.client().get('/actors?fields=id,name&sort=-age',
+                                       headers=assistant_header)
+        data = json.loads(result.data)
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(set(data['actors'][0]), {'id', 'name'})
+        self.assertNotIn('gender', queries.statements[0])
+
+        result = self.client().get('/movies/1/actors?fields=name',
+                                   headers=assistant_header)
+        data = json.loads(result.data)
+        self.assertEqual(set(data['actors'][0]), {'name', 'movie_budget'})
+
+        result = self.client().get('/movies?fields=budget',
+                                   headers=assistant_header)
+        self.assertEqual(result.status_code, 400)
+
+    def test_list_payload_format(self):
+        """The fast read path keeps jsonify's payload format"""
+        result = self.client().get('/movies?include=actors',
+                                   headers=assistant_header)
+        data = json.loads(result.data)
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.mimetype, 'application/json')
+        movie = data['movies'][0]
+        self.assertEqual(set(movie), {'id', 'title', 'release_date',
+                                      'version', 'actors'})
+        self.assertTrue(movie['release_date'].endswith(' 00:00:00 GMT'))
+        self.assertEqual(set(movie['actors'][0]),
+                         {'id', 'name', 'gender', 'age', 'version'})
+
+    def test_export_movies(self):
+        """Stream the movie catalog as NDJSON and CSV"""
+        result = self.client().get('/movies/export', headers=assistant_header)
+        self.assertEqual(result.status_code, 200)
+        rows = [json.loads(line) for line in result.data.splitlines()]
+        self.assertEqual(rows[0]['id'], 1)
+
+        result = self.client().get(
+            '/movies/export?format=csv', headers=assistant_header)
+        self.assertEqual(result.status_code, 200)
+        self.assertTrue(result.data.startswith(b'id,title,release_date'))
+
+    def test_get_movies_release_window(self):
+        """GET movies releasing in a date window"""
+        result = self.client().get(
+            '/movies?release_date_from=2000-01-01&sort=release_date',
+            headers=assistant_header)
+        data = json.loads(result.data)
+        self.assertEqual(result.status_code, 200)
+        self.assertTrue(len(data['movies']) > 0)
+
+        result = self.client().get(
+            '/movies?release_date_to=1900-01-01', headers=assistant_header)
+        self.assertEqual(result.status_code, 404)
+
     def test_error_401__movies(self):
         """GET movies no Authorization"""
         result = self.client().get('/movies?page=1')
@@ -233,6 +637,85 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(result.status_code, 401)
         self.assertFalse(data['success'])
 
+    # ---------------------------------
+    # POST/DELETE /movies/<id>/actors
+    # ---------------------------------
+
+    def test_attach_and_detach_actors(self):
+        """Link and unlink actors with budgets"""
+        links = {'actors': [{'id': 1, 'movie_budget': 500.0}, {'id': 2}]}
+        result = self.client().post(
+            '/movies/1/actors', json=links, headers=producer_header)
+        data = json.loads(result.data)
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(data['attached'], [1, 2])
+
+        result = self.client().get(
+            '/actors/1/movies', headers=assistant_header)
+        data = json.loads(result.data)
+        self.assertEqual(result.status_code, 200)
+        self.assertIn(500.0, [m['movie_budget'] for m in data['movies']])
+
+        result = self.client().delete(
+            '/movies/1/actors?ids=1,2', headers=producer_header)
+        data = json.loads(result.data)
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(data['detached'], 2)
+
+    def test_attach_unknown_actor(self):
+        """Linking an actor that does not exist"""
+        result = self.client().post(
+            '/movies/1/actors', json=[{'id': 9999}], headers=producer_header)
+        data = json.loads(result.data)
+        self.assertEqual(result.status_code, 422)
+        self.assertFalse(data['success'])
+
+        result = self.client().post('/movies/1/actors', json=[
+            {'id': 10 ** 20}], headers=producer_header)
+        self.assertEqual(result.status_code, 422)
+        too_many = ','.join(str(i) for i in range(BULK_MAX_RECORDS + 1))
+        for ids in ('9' * 20, too_many):
+            result = self.client().delete(
+                '/movies/1/actors?ids=' + ids, headers=producer_header)
+            self.assertEqual(result.status_code, 400)
+
+    # -------------------------
+    # GET /stats
+    # -------------------------
+
+    def test_budget_stats(self):
+        """Budget totals follow link changes"""
+        self.client().post('/movies/1/actors', json=[
+            {'id': 2, 'movie_budget': 50.0}], headers=producer_header)
+        result = self.client().get(
+            '/stats/budgets?group=movie', headers=assistant_header)
+        data = json.loads(result.data)
+        self.assertEqual(result.status_code, 200)
+        movie = [row for row in data['budgets'] if row['movie_id'] == 1][0]
+        self.assertEqual(movie['total_budget'], 100050.0)
+        self.assertEqual(movie['actor_count'], 2)
+
+        result = self.client().get(
+            '/stats/actors/2', headers=assistant_header)
+        data = json.loads(result.data)
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(data['movie_count'], 2)
+
+    def test_delete_movie_month_stats(self):
+        """Deleting a movie takes it out of its release month totals"""
+        self.client().delete('/movies/3', headers=producer_header)
+        result = self.client().get(
+            '/stats/budgets?group=month', headers=assistant_header)
+        months = json.loads(result.data)['budgets']
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(sum(month['movie_count'] for month in months), 2)
+
+    def test_404_actor_stats(self):
+        """Stats of an actor that does not exist"""
+        result = self.client().get(
+            '/stats/actors/9999', headers=assistant_header)
+        self.assertEqual(result.status_code, 404)
+
     # -------------------------
     # PATCH /movies
     # -------------------------
@@ -271,8 +754,390 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertFalse(data['success'])
         self.assertEqual(data['message'], 'bad request')
 
+    def test_app_built_once(self):
+        """Importing app builds nothing, get_app builds one app"""
+        app_module._app = None
+        self.assertIs(app_module.get_app(), app_module.get_app())
+        app_module._app = None
+
+    def test_server_timing(self):
+        """Sampled requests report SQL, auth and serialization time"""
+        app = create_app({'DB_PROFILE': 'sqlite-memory',
+                          'AUTH_MODE': 'offline', 'TIMING_SAMPLE_RATE': 1})
+        with app.app_context():
+            db_reboot()
+        result = app.test_client().get(
+            '/actors?sort=name', headers=assistant_header)
+        timing = result.headers['Server-Timing']
+        self.assertEqual(result.status_code, 200)
+        self.assertRegex(timing, r'sql;dur=[0-9.]+;desc="[1-9][0-9]* stat')
+        self.assertIn('auth;dur=', timing)
+        self.assertIn('serialize;dur=', timing)
+        self.assertIn('total;dur=', timing)
+
+        unsampled = create_app({'DB_PROFILE': 'sqlite-memory',
+                                'AUTH_MODE': 'offline',
+                                'TIMING_SAMPLE_RATE': 0})
+        result = unsampled.test_client().get('/health')
+        self.assertNotIn('Server-Timing', result.headers)
+
+    def test_rate_limit(self):
+        """A sub over its quota gets 429 with Retry-After"""
+        app = create_app({'DB_PROFILE': 'sqlite-memory',
+                          'AUTH_MODE': 'offline',
+                          'RATE_LIMITS': 'get=0.01/2,default=100/100'})
+        with app.app_context():
+            db_reboot()
+        client = app.test_client()
+        header = {'Authorization': 'Bearer ' + mint_token(
+            'casting_director', sub='local|rate-limited')}
+        for _ in range(2):
+            self.assertEqual(client.get(
+                '/actors', headers=header).status_code, 200)
+        result = client.get('/actors', headers=header)
+        data = json.loads(result.data)
+        self.assertEqual(result.status_code, 429)
+        self.assertEqual(data['message'], 'rate limit exceeded')
+        self.assertGreater(int(result.headers['Retry-After']), 1)
+        # other permissions and other subs have their own buckets
+        self.assertEqual(client.post('/actors', json={
+            'name': 'Ann', 'age': 30, 'gender': 'female'
+        }, headers=header).status_code, 200)
+        other = {'Authorization': 'Bearer ' + mint_token(
+            'casting_director', sub='local|other')}
+        self.assertEqual(client.get(
+            '/actors', headers=other).status_code, 200)
+
+    def test_metrics(self):
+        """/metrics exposes latency histograms and process counters"""
+        self.client().get('/actors', headers=assistant_header)
+        result = self.client().get('/metrics')
+        text = result.data.decode('utf-8')
+        self.assertEqual(result.status_code, 200)
+        self.assertTrue(result.mimetype.startswith('text/plain'))
+        self.assertIn('http_request_duration_seconds_bucket{method="GET",'
+                      'route="/actors",status="200",le="+Inf"}', text)
+        self.assertRegex(text, r'sql_statements_total\{route="/actors"\} \d')
+        self.assertIn('# TYPE jwks_fetches_total counter', text)
+        self.assertRegex(text, r'token_cache_hit_ratio [0-9.]+\n')
+        self.assertIn('http_requests_in_flight 0\n', text)
+
+    def test_metrics_add_up_workers(self):
+        """Snapshots of other workers are summed, gauges only if alive"""
+        directory = tempfile.mkdtemp()
+        app = create_app({'DB_PROFILE': 'sqlite-memory',
+                          'AUTH_MODE': 'offline', 'METRICS_DIR': directory})
+        with app.app_context():
+            db_reboot()
+            own = metrics.snapshot(db.engine)
+        exited = dict(own, pid=4194305, requests=[
+            ['GET', '/workers', '200', [1] + [0] * 11, 0.002, 1]],
+            gauges=dict(own['gauges'], db_pool_size=99))
+        with open(os.path.join(directory, 'metrics-4194305.json'),
+                  'w') as snapshot_file:
+            json.dump(exited, snapshot_file)
+        text = app.test_client().get('/metrics').data.decode('utf-8')
+        self.assertIn('http_request_duration_seconds_count{method="GET",'
+                      'route="/workers",status="200"} 1\n', text)
+        self.assertNotIn('db_pool_size 99', text)
+        self.assertTrue(os.path.exists(os.path.join(
+            directory, 'metrics-{}.json'.format(os.getpid()))))
+
+    def test_read_replica_routing(self):
+        """Reads use the replica unless the client just wrote or it lags"""
+        replica_path = os.path.join(tempfile.mkdtemp(), 'replica.db')
+        app = create_app({'DB_PROFILE': 'sqlite-memory',
+                          'AUTH_MODE': 'offline',
+                          'REPLICA_DATABASE_URI': 'sqlite:///' + replica_path})
+        with app.app_context():
+            db_reboot()
+            replica = db.get_engine(app, bind='replica')
+            db.metadata.create_all(bind=replica)
+            replica.execute(Actor.__table__.insert().values(
+                id=99, name='Replica', age=40, gender='female', version=1))
+        reader, writer = app.test_client(), app.test_client()
+        header = {'Authorization': 'Bearer ' + mint_token('casting_director')}
+
+        def names(client):
+            result = client.get('/actors?fields=name&page_size=17',
+                                headers=header)
+            self.assertEqual(result.status_code, 200)
+            return [actor['name'] for actor in json.loads(
+                result.data)['actors']]
+
+        self.assertEqual(names(reader), ['Replica'])
+        result = writer.post('/actors', json={
+            'name': 'Primary', 'age': 30, 'gender': 'male'
+        }, headers=header)
+        self.assertEqual(result.status_code, 200)
+        self.assertIn('read_primary_until=', result.headers['Set-Cookie'])
+        self.assertEqual(names(reader), ['Replica'])
+        # the replica's response was not cached for the writer to get
+        self.assertIn('Primary', names(writer))
+
+        # the cookie pins the client on any worker, for the window only
+        router = app.extensions['replica']
+        reads = router.reads
+        other = app.test_client()
+        until = result.headers['Set-Cookie'].split(';')[0].split('=')[1]
+        other.set_cookie('localhost', 'read_primary_until', until)
+        names(other)
+        self.assertEqual(router.reads, reads)
+        other.set_cookie('localhost', 'read_primary_until',
+                         str(time.time() + 3600))
+        names(other)
+        self.assertEqual(router.reads, reads + 1)
+
+        router.lag = router.max_lag + 1
+        router.checked_at = time.monotonic()
+        self.assertIn('Primary', names(reader))
+        health = json.loads(reader.get('/health/db').data)
+        self.assertEqual(health['replica']['fallbacks'], 1)
+
+    def test_in_flight_cap(self):
+        """Requests beyond MAX_IN_FLIGHT are shed with 503"""
+        app = create_app({'DB_PROFILE': 'sqlite-memory',
+                          'AUTH_MODE': 'offline', 'MAX_IN_FLIGHT': 1})
+        with app.app_context():
+            db_reboot()
+        client = app.test_client()
+        self.assertTrue(in_flight.enter(0))
+        try:
+            result = client.get('/actors', headers=assistant_header)
+            self.assertEqual(result.status_code, 503)
+            self.assertEqual(result.headers['Retry-After'], '1')
+            self.assertEqual(client.get('/health').status_code, 200)
+        finally:
+            in_flight.exit()
+        self.assertEqual(client.get(
+            '/actors', headers=assistant_header).status_code, 200)
+        self.assertEqual(in_flight.count, 0)
+
     '''run: python test_app.py to execute test cases'''
 
 
+class JWKSStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.json')
+        os.close(handle)
+        self.write_keys('kid-1')
+        self.store = JWKSStore(path=self.path, ttl=3600,
+                               min_refetch_interval=60)
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def write_keys(self, *kids):
+        with open(self.path, 'w') as jwks_file:
+            json.dump({'keys': [{
+                'kty': 'RSA', 'kid': kid, 'use': 'sig', 'n': 'n', 'e': 'AQAB'
+            } for kid in kids]}, jwks_file)
+
+    def test_key_lookup_by_kid(self):
+        """JWKS keys are fetched once and indexed by kid"""
+        self.assertEqual(self.store.get_key('kid-1')['kid'], 'kid-1')
+        self.assertEqual(self.store.get_key('kid-1')['kid'], 'kid-1')
+        self.assertEqual(self.store.fetch_count, 1)
+
+    def test_unknown_kid_refetch_is_rate_limited(self):
+        """Unknown kid forces one refetch, then waits for the interval"""
+        self.store.get_key('kid-1')
+        self.store._last_attempt -= 60
+        self.write_keys('kid-1', 'kid-2')
+        self.assertEqual(self.store.get_key('kid-2')['kid'], 'kid-2')
+        self.assertIsNone(self.store.get_key('kid-3'))
+        self.assertIsNone(self.store.get_key('kid-3'))
+        self.assertEqual(self.store.fetch_count, 2)
+
+    def test_stale_keys_served_when_idp_down(self):
+        """Last good keys are served when the refresh fails"""
+        self.store.get_key('kid-1')
+        os.remove(self.path)
+        self.assertFalse(self.store.refresh())
+        self.assertEqual(self.store.get_key('kid-1')['kid'], 'kid-1')
+        self.assertEqual(self.store.fetch_errors, 1)
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    def test_hit_after_set(self):
+        """Verified tokens are served from the cache"""
+        cache = TokenCache(max_size=10)
+        payload = {'exp': time.time() + 60, 'permissions': ['get:actors']}
+        self.assertIsNone(cache.get('token'))
+        cache.set('token', payload)
+        entry = cache.get('token')
+        self.assertEqual(entry.payload, payload)
+        self.assertIn('get:actors', entry.permissions)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_expired_token_not_served(self):
+        """Payloads are never served past exp"""
+        cache = TokenCache(max_size=10)
+        entry = cache.set(
+            'token', {'exp': time.time() + 60, 'permissions': []})
+        cache._entries.set(cache._key('token'),
+                           entry._replace(exp=time.time() - 1))
+        self.assertIsNone(cache.get('token'))
+        self.assertEqual(len(cache), 0)
+
+    def test_size_cap(self):
+        """Least recently used tokens are evicted"""
+        cache = TokenCache(max_size=2)
+        for token in ('a', 'b', 'c'):
+            cache.set(token, {'exp': time.time() + 60, 'permissions': []})
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('a'))
+
+
+class ImporterTestCase(unittest.TestCase):
+    class Connection:
+        """Records what import_file sends instead of running it"""
+
+        def __init__(self):
+            self.statements = []
+            self.rowcount = 0
+
+        def cursor(self):
+            return self
+
+        def execute(self, statement):
+            self.statements.append(statement)
+
+        def copy_expert(self, statement, stream):
+            self.statements.append(statement)
+            while stream.read(16):
+                pass
+
+        def commit(self):
+            pass
+
+        def close(self):
+            pass
+
+    def test_import_lifts_statement_timeout(self):
+        """Imports run without the pool's statement_timeout"""
+        handle, path = tempfile.mkstemp(suffix='.ndjson')
+        with os.fdopen(handle, 'w') as source:
+            source.write('{"name": "Ann", "age": 30}\n')
+        connection = self.Connection()
+        self.assertEqual(import_file(connection, 'actors', path,
+                                     report=lambda line: None), 1)
+        os.remove(path)
+        rebuild_budget_stats(connection, report=lambda line: None)
+        self.assertEqual(connection.statements[0], NO_STATEMENT_TIMEOUT)
+        self.assertEqual(connection.statements.count(NO_STATEMENT_TIMEOUT),
+                         2)
+
+    def test_copy_stream(self):
+        """Records are rendered as COPY CSV lines in reads of any size"""
+        reports = []
+        stream = CopyStream(iter([
+            {'name': 'Ann, Lee', 'gender': '', 'age': 30},
+            {'id': 7, 'name': 'Bo', 'age': None}
+        ]), ('id', 'name', 'gender', 'age'), reports.append, 'actors')
+        chunks = []
+        while True:
+            chunk = stream.read(5)
+            if not chunk:
+                break
+            self.assertTrue(len(chunk) <= 5)
+            chunks.append(chunk)
+        self.assertEqual(''.join(chunks), ',"Ann, Lee",,30\r\n7,Bo,,\r\n')
+        self.assertEqual(stream.count, 2)
+        self.assertTrue(stream.progress().startswith('actors: 2 rows'))
+
+    def test_upsert_statements(self):
+        """Id-less rows get ids past the imported ones and are not upserted"""
+        setval, keyed, new = upsert_statements(
+            'actors', ('id', 'name', 'age'), 'import_actors')
+        self.assertIn('setval', setval)
+        self.assertIn('(SELECT MAX(id) FROM import_actors)', setval)
+        self.assertIn('WHERE id IS NOT NULL', keyed)
+        self.assertIn('ON CONFLICT (id) DO UPDATE', keyed)
+        self.assertEqual(new, 'INSERT INTO actors ("name", "age") SELECT '
+                              '"name", "age" FROM import_actors '
+                              'WHERE id IS NULL')
+
+        links, = upsert_statements(
+            'movie_launch', ('Movie_id', 'Actor_id', 'movie_budget'),
+            'import_movie_launch')
+        self.assertIn('ON CONFLICT ("Movie_id", "Actor_id")', links)
+
+
+class QueryBudgetTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app({'DB_PROFILE': 'sqlite-memory',
+                               'AUTH_MODE': 'offline'})
+
+    def test_routes_within_budget(self):
+        """Every route stays within its declared statement budget"""
+        ids = seed(self.app, 60, 20, 5, 5)
+        budgets = route_budgets(self.app)
+        tokens = mint_tokens(1)
+        client = AppClient(self.app)
+        adapter = self.app.url_map.bind('localhost')
+        for scenario in scenarios(*ids):
+            path = scenario.path(0)
+            endpoint, args = adapter.match(path.split('?')[0],
+                                           method=scenario.method)
+            if endpoint not in budgets:
+                continue
+            with count_queries() as queries:
+                status = client.request(
+                    scenario.method, path,
+                    scenario_headers(scenario, tokens),
+                    scenario.body(0) if scenario.body else None)
+            self.assertEqual(status, 200, scenario.name)
+            self.assertLessEqual(queries.count, budgets[endpoint],
+                                 scenario.name)
+
+    def test_statement_shape(self):
+        """IN lists of any length have the same shape"""
+        self.assertEqual(
+            statement_shape('SELECT * FROM actors WHERE id IN (?, ?)'),
+            statement_shape('SELECT *  FROM actors\nWHERE id IN (?, ?, ?)'))
+
+    def test_debug_warnings(self):
+        """Over-budget requests and repeated statements are logged"""
+        self.app.config['QUERY_BUDGET_WARNINGS'] = True
+
+        @self.app.route('/n-plus-one')
+        @query_budget(1)
+        def n_plus_one():
+            for actor_id in range(3):
+                db.session.query(Actor).get(actor_id)
+            return 'ok'
+
+        with self.app.app_context():
+            db_reboot()
+        with self.assertLogs('query_budget', 'WARNING') as logs:
+            self.app.test_client().get('/n-plus-one')
+        self.assertIn('budget is 1', logs.output[0])
+        self.assertIn('same statement 3 times', logs.output[1])
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    def test_every_route_runs(self):
+        """The benchmark covers every route without errors"""
+        app = create_app({'DB_PROFILE': 'sqlite-memory',
+                          'AUTH_MODE': 'offline'})
+        results = run_benchmark(app=app, actors=20, movies=5, requests=3,
+                                concurrency=1, warmup=0, log=lambda line: None)
+        self.assertEqual(uncovered_routes(app, scenarios(
+            [1], [2], [1], [2])), [])
+        for name, result in results.items():
+            self.assertEqual(result['errors'], 0, name)
+
+    def test_compare_flags_regressions(self):
+        """Slower endpoints are reported as regressions"""
+        before = {'endpoints': {'GET /actors': {
+            'rps': 100.0, 'p50_ms': 1.0, 'p99_ms': 5.0}}}
+        after = {'endpoints': {'GET /actors': {
+            'rps': 50.0, 'p50_ms': 2.0, 'p99_ms': 9.0}}}
+        self.assertEqual(compare(before, after, 10.0), ['GET /actors'])
+        self.assertEqual(compare(before, before, 10.0), [])
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,59 @@
+import hashlib
+import time
+from collections import namedtuple
+
+from config import TOKEN_CACHE_SIZE
+from lru import LRUCache
+
+'''
+Verified token cache
+Maps sha256(token) to the decoded payload and a frozenset of its
+permissions until the token's exp, so a repeated bearer token skips
+the RS256 signature check and claim validation.
+'''
+
+CachedToken = namedtuple('CachedToken', ['payload', 'permissions', 'exp'])
+
+
+class TokenCache:
+    def __init__(self, max_size=TOKEN_CACHE_SIZE):
+        self._entries = LRUCache(max_size)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    def get(self, token):
+        key = self._key(token)
+        entry = self._entries.get(key)
+        if entry is not None and entry.exp <= time.time():
+            self._entries.delete(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def set(self, token, payload):
+        '''
+        Returns the entry for payload, cached only when it has an exp.
+        '''
+        permissions = None
+        if 'permissions' in payload:
+            permissions = frozenset(payload['permissions'])
+        entry = CachedToken(payload, permissions, payload.get('exp'))
+        if isinstance(entry.exp, (int, float)) and entry.exp > time.time():
+            self._entries.set(self._key(token), entry)
+        return entry
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+token_cache = TokenCache()
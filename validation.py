@@ -0,0 +1,168 @@
+from datetime import date, datetime
+
+from werkzeug.http import parse_date as parse_http_date
+
+from pagination import MAX_ID
+
+'''
+Record validation shared by the single and bulk write endpoints
+Each validator returns (row, error) where row is ready for an INSERT.
+'''
+
+
+def parse_date(value):
+    '''
+    Accepts a date, an ISO 8601 string or the RFC 1123 form
+    jsonify emits ("Mon, 10 Aug 2020 00:00:00 GMT").
+    '''
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    if not isinstance(value, str):
+        return None
+    try:
+        return date.fromisoformat(value[:10])
+    except ValueError:
+        parsed = parse_http_date(value)
+        return parsed.date() if parsed else None
+
+
+def validate_actor(record):
+    if not isinstance(record, dict):
+        return None, 'record must be an object.'
+    name = record.get('name', None)
+    age = record.get('age', None)
+    gender = record.get('gender', None)
+    if not name or not age:
+        return None, 'name or age not provided.'
+    if not isinstance(name, str):
+        return None, 'name must be a string.'
+    if isinstance(age, bool) or not isinstance(age, int) or \
+            not 0 <= age <= MAX_ID:
+        return None, 'age must be a positive integer.'
+    if gender is not None and not isinstance(gender, str):
+        return None, 'gender must be a string.'
+    return {'name': name, 'age': age, 'gender': gender}, None
+
+
+def validate_movie(record):
+    if not isinstance(record, dict):
+        return None, 'record must be an object.'
+    title = record.get('title', None)
+    release_date = record.get('release_date', None)
+    if not title or not release_date:
+        return None, 'title or release_date not provided.'
+    if not isinstance(title, str):
+        return None, 'title must be a string.'
+    release_date = parse_date(release_date)
+    if release_date is None:
+        return None, 'release_date is not a valid date.'
+    return {'title': title, 'release_date': release_date}, None
+
+
+def check_text(value):
+    if not value or not isinstance(value, str):
+        return None, 'must be a non-empty string.'
+    return value, None
+
+
+def check_optional_text(value):
+    if value is not None and not isinstance(value, str):
+        return None, 'must be a string.'
+    return value, None
+
+
+def check_age(value):
+    if isinstance(value, bool) or not isinstance(value, int) or \
+            not 0 <= value <= MAX_ID:
+        return None, 'must be a positive integer.'
+    return value, None
+
+
+def check_date(value):
+    parsed = parse_date(value)
+    if parsed is None:
+        return None, 'is not a valid date.'
+    return parsed, None
+
+
+# columns a bulk PATCH may change, with their checks
+ACTOR_CHANGES = {
+    'name': check_text,
+    'gender': check_optional_text,
+    'age': check_age
+}
+
+MOVIE_CHANGES = {
+    'title': check_text,
+    'release_date': check_date
+}
+
+
+def validate_update(record, checks):
+    '''
+    Validates {"id": 1, "changes": {...}, "version": 3}, version optional,
+    and returns ((id, changes, version), error).
+    '''
+    if not isinstance(record, dict):
+        return None, 'record must be an object.'
+    record_id = record.get('id', None)
+    version = record.get('version', None)
+    changes = record.get('changes', None)
+    if isinstance(record_id, bool) or not isinstance(record_id, int) or \
+            abs(record_id) > MAX_ID:
+        return None, 'id must be an integer.'
+    if version is not None and (
+            isinstance(version, bool) or not isinstance(version, int) or
+            abs(version) > MAX_ID):
+        return None, 'version must be an integer.'
+    if not isinstance(changes, dict) or not changes:
+        return None, 'changes must be a non-empty object.'
+    unknown = sorted(set(changes) - set(checks))
+    if unknown:
+        return None, 'cannot change {}.'.format(', '.join(unknown))
+    values = {}
+    for field, value in changes.items():
+        values[field], error = checks[field](value)
+        if error:
+            return None, '{} {}'.format(field, error)
+    return (record_id, values, version), None
+
+
+def parse_ids(value):
+    '''Parses "1,5,9" into [1, 5, 9], returns None when malformed.'''
+    try:
+        ids = [int(part) for part in value.split(',') if part.strip()]
+    except (AttributeError, ValueError):
+        return None
+    if any(abs(record_id) > MAX_ID for record_id in ids):
+        return None
+    return ids or None
+
+
+def validate_links(records):
+    '''
+    Validates [{"id": actor_id, "movie_budget": 100.0}, ...]
+    and returns ({actor_id: movie_budget}, errors).
+    '''
+    budgets, errors = {}, []
+    for index, record in enumerate(records):
+        if not isinstance(record, dict):
+            errors.append({'index': index,
+                           'message': 'record must be an object.'})
+            continue
+        actor_id = record.get('id', None)
+        movie_budget = record.get('movie_budget', None)
+        if isinstance(actor_id, bool) or not isinstance(actor_id, int) or \
+                abs(actor_id) > MAX_ID:
+            errors.append({'index': index,
+                           'message': 'actor id must be an integer.'})
+        elif movie_budget is not None and (
+                isinstance(movie_budget, bool) or
+                not isinstance(movie_budget, (int, float))):
+            errors.append({'index': index,
+                           'message': 'movie_budget must be a number.'})
+        else:
+            budgets[actor_id] = movie_budget
+    return budgets, errors
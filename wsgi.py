@@ -1,3 +1,3 @@
-from app import create_app
+from app import get_app
 
-app = create_app()
+app = get_app()